@@ -0,0 +1,383 @@
+#    Copyright 2012-2013 Sebastien Maccagnoni-Munch
+#
+#    This file is part of OSPFM.
+#
+#    OSPFM is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    OSPFM is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with OSPFM.  If not, see <http://www.gnu.org/licenses/>.
+
+# Benchmark of the main endpoints on a large synthetic dataset
+#
+#   python benchmark.py [options]      (see "python benchmark.py --help")
+#
+# For each database (a SQLite file and optionally a PostgreSQL database), all
+# tables are DROPPED and created again, filled with generated users, accounts,
+# categories trees and transactions, then the main endpoints are timed with
+# the Flask test client. Never give the URL of a database with real data.
+#
+# Results are printed and written to a JSON report: reports obtained with the
+# same parameters (and seed) may be compared between versions of OSPFM.
+#
+# Exchange rates are fixed (BENCHMARK_RATES): they are put in the configured
+# cache and stored in the database, the provider is never called.
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import tempfile
+import time
+import uuid
+from decimal import Decimal
+
+import sqlalchemy
+from passlib.hash import sha512_crypt
+from sqlalchemy import event
+
+from ospfm import app, config, db, init_db
+from ospfm.core import exchangerate
+from ospfm.core import models as core
+from ospfm.transaction import balance, closure, rollup
+from ospfm.transaction import models as transaction
+
+from createdb import populate_currencies
+
+BENCHMARK_RATES = {'EUR': 0.75, 'GBP': 0.65, 'JPY': 100, 'USD': 1}
+BENCHMARK_PASSWORD = 'benchmark'
+# Currencies of the generated accounts (the preferred currency is the first)
+ACCOUNT_CURRENCIES = ('EUR', 'EUR', 'USD', 'GBP')
+# Transactions dates are spread over this number of days before today
+HISTORY_DAYS = 730
+# Number of rows inserted at once
+INSERT_CHUNK = 1000
+
+ENDPOINTS = (
+    ('accounts', '/accounts'),
+    ('categories', '/categories'),
+    ('transactions filter', '/transactions/filter'),
+    ('transactions filter (period)',
+     '/transactions/filter?dates={month_ago}-{today}'),
+    ('exchange rate', '/currencies/EUR/rate/USD'),
+)
+
+
+########## Generator
+
+def insert(model, rows):
+    """Insert rows in chunks, without creating objects"""
+    for start in range(0, len(rows), INSERT_CHUNK):
+        db.session.execute(model.__table__.insert(),
+                           rows[start:start+INSERT_CHUNK])
+
+def ids(query):
+    """Return a {name: id} dictionary from a (name, id) query"""
+    return dict(query.all())
+
+def generate(users, accounts, categories, depth, transactions, splits):
+    """
+    Generate the dataset, return the usernames and the number of rows of each
+    table
+    """
+    currencies = ids(db.session.query(core.Currency.isocode, core.Currency.id
+                     ).filter(core.Currency.owner_username == None))
+    rates = dict([ (isocode, Decimal(str(rate)))
+                   for isocode, rate in BENCHMARK_RATES.items() ])
+    preferred = ACCOUNT_CURRENCIES[0]
+    # All users have the same password, hashed only once
+    passhash = sha512_crypt.encrypt(BENCHMARK_PASSWORD, rounds=1000)
+    usernames = [ 'bench{0}'.format(number) for number in range(users) ]
+    insert(core.User, [
+        {'username': username, 'first_name': '', 'last_name': '',
+         'passhash': passhash, 'preferred_currency_id': currencies[preferred]}
+        for username in usernames
+    ])
+    today = datetime.date.today()
+    for username in usernames:
+        # Accounts (named after their owner: they do not have an owner column)
+        accountsdata = [
+            ('{0} account {1}'.format(username, number),
+             ACCOUNT_CURRENCIES[number % len(ACCOUNT_CURRENCIES)])
+            for number in range(accounts)
+        ]
+        insert(transaction.Account, [
+            {'name': name, 'currency_id': currencies[isocode],
+             'start_balance': Decimal(random.randint(0, 500000)) / 100}
+            for name, isocode in accountsdata
+        ])
+        accountids = ids(db.session.query(
+                            transaction.Account.name, transaction.Account.id
+                         ).filter(transaction.Account.name.in_(
+                            [ name for name, isocode in accountsdata ]
+                         )))
+        insert(transaction.AccountOwner, [
+            {'account_id': accountid, 'owner_username': username}
+            for accountid in accountids.values()
+        ])
+        accountcurrencies = [ (accountids[name], isocode)
+                              for name, isocode in accountsdata ]
+        # Categories, level by level, each one with a parent in the previous
+        # level
+        categoryids = {}
+        parents = [None]
+        perlevel = max(categories / depth, 1)
+        number = 0
+        for level in range(depth):
+            count = perlevel if level < depth - 1 else categories - number
+            names = [ 'Category {0}'.format(number + i)
+                      for i in range(count) ]
+            number += count
+            insert(transaction.Category, [
+                {'owner_username': username, 'name': name,
+                 'currency_id': currencies[preferred],
+                 'parent_id': random.choice(parents)}
+                for name in names
+            ])
+            levelids = ids(db.session.query(
+                                transaction.Category.name,
+                                transaction.Category.id
+                           ).filter(
+                                transaction.Category.owner_username ==
+                                                                    username,
+                                transaction.Category.name.in_(names)
+                           ))
+            categoryids.update(levelids)
+            parents = levelids.values() or parents
+        categoryids = categoryids.values()
+        # Transactions (named after their number, to find their ids)
+        transactionsdata = []
+        for number in range(transactions):
+            accountid, isocode = random.choice(accountcurrencies)
+            amount = Decimal(random.randint(-20000, 10000)) / 100
+            transactionsdata.append((
+                'Transaction {0}'.format(number), accountid, isocode, amount,
+                today - datetime.timedelta(
+                                        days=random.randint(0, HISTORY_DAYS))
+            ))
+        insert(transaction.Transaction, [
+            {'owner_username': username, 'description': description,
+             'original_description': description, 'amount': amount,
+             'currency_id': currencies[isocode], 'date': date}
+            for description, accountid, isocode, amount, date
+            in transactionsdata
+        ])
+        transactionids = ids(db.session.query(
+                                transaction.Transaction.description,
+                                transaction.Transaction.id
+                             ).filter(
+                                transaction.Transaction.owner_username ==
+                                                                      username
+                             ))
+        transactionaccounts = []
+        transactioncategories = []
+        for description, accountid, isocode, amount, date in transactionsdata:
+            transactionid = transactionids[description]
+            transactionaccounts.append({
+                'transaction_id': transactionid, 'account_id': accountid,
+                'amount': amount, 'verified': False
+            })
+            # Split the amount between categories
+            splitcategories = random.sample(
+                            categoryids,
+                            min(random.randint(1, splits), len(categoryids))
+                         )
+            remaining = amount
+            for position, categoryid in enumerate(splitcategories):
+                if position == len(splitcategories) - 1:
+                    splitamount = remaining
+                else:
+                    splitamount = (amount / len(splitcategories)).quantize(
+                                                             Decimal('0.01'))
+                remaining -= splitamount
+                transactioncategories.append({
+                    'transaction_id': transactionid,
+                    'category_id': categoryid,
+                    'transaction_amount': splitamount,
+                    'category_amount': (splitamount * rates[preferred] /
+                                        rates[isocode]).quantize(
+                                                             Decimal('0.01'))
+                })
+        insert(transaction.TransactionAccount, transactionaccounts)
+        insert(transaction.TransactionCategory, transactioncategories)
+        db.session.commit()
+    # Derived data
+    closure.rebuild()
+    balance.rebuild_accounts()
+    db.session.commit()
+    first, last = rollup.history()
+    if first:
+        for batchfirst, batchlast in rollup.batches(first, last):
+            rollup.rebuild(first=batchfirst, last=batchlast)
+            db.session.commit()
+    return usernames, dict([
+        (model.__tablename__, model.query.count()) for model in (
+            core.User, transaction.Account, transaction.Category,
+            transaction.CategoryClosure, transaction.Transaction,
+            transaction.TransactionAccount, transaction.TransactionCategory,
+            transaction.CategoryDailyTotal
+        )
+    ])
+
+
+########## Runner
+
+def setrates():
+    """Use the benchmark exchange rates"""
+    rates = {'timestamp': int(time.time()), 'rates': BENCHMARK_RATES}
+    config.EXCHANGE_RATES_PROVIDER = lambda: rates
+    config.CACHE.set(exchangerate.RATES_KEY, rates, exchangerate.RATES_KEEP)
+    # Also stored as the rates of the first day, for conversions at a date
+    exchangerate.store({
+        'timestamp': int(time.time()) - (HISTORY_DAYS + 1) * 86400,
+        'rates': BENCHMARK_RATES
+    })
+
+def login(client, username):
+    response = client.post('/login', data={'username': username,
+                                           'password': BENCHMARK_PASSWORD},
+                           environ_base={'REMOTE_ADDR': '127.0.0.1'})
+    return json.loads(response.data)['response']['key']
+
+def measure(client, url, keys, repeat):
+    """Request an url "repeat" times, return timings and queries counts"""
+    statements = []
+    def count(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+    event.listen(db.engine, 'before_cursor_execute', count)
+    durations = []
+    queries = []
+    errors = 0
+    try:
+        for number in range(repeat):
+            del statements[:]
+            start = time.time()
+            response = client.get(
+                            url,
+                            headers={'Authorization': keys[number % len(keys)]},
+                            environ_base={'REMOTE_ADDR': '127.0.0.1'}
+                       )
+            durations.append((time.time() - start) * 1000)
+            queries.append(len(statements))
+            if response.status_code != 200:
+                errors += 1
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', count)
+    durations.sort()
+    return {
+        'requests': repeat,
+        'errors': errors,
+        'min_ms': round(durations[0], 3),
+        'median_ms': round(durations[len(durations) / 2], 3),
+        'mean_ms': round(sum(durations) / len(durations), 3),
+        'p95_ms': round(durations[int(len(durations) * 0.95)], 3),
+        'max_ms': round(durations[-1], 3),
+        'queries': max(queries),
+    }
+
+def benchmark(url, options):
+    """Generate the dataset in a database and time the endpoints"""
+    # Requests must use this database only
+    db.session.remove()
+    db.replicas = []
+    app.config['SQLALCHEMY_DATABASE_URI'] = url
+    random.seed(options.seed)
+    with app.app_context():
+        db.drop_all()
+        init_db()
+        populate_currencies()
+        setrates()
+        start = time.time()
+        usernames, rows = generate(options.users, options.accounts,
+                                   options.categories, options.depth,
+                                   options.transactions, options.splits)
+        generation = time.time() - start
+        db.session.remove()
+    print '{0}: dataset generated in {1:.1f}s'.format(db.engine.name,
+                                                     generation)
+    client = app.test_client()
+    keys = [ login(client, username) for username in usernames ]
+    today = datetime.date.today()
+    endpoints = {}
+    for name, endpoint in ENDPOINTS:
+        endpoint = endpoint.format(
+            today=today.strftime('%Y%m%d'),
+            month_ago=(today - datetime.timedelta(days=30)).strftime('%Y%m%d')
+        )
+        # The first request is not measured (caches, lazy initializations)
+        measure(client, endpoint, keys, 1)
+        endpoints[name] = measure(client, endpoint, keys, options.repeat)
+        endpoints[name]['url'] = endpoint
+        print '  {0:32} median {1:9.3f} ms, p95 {2:9.3f} ms, ' \
+              '{3:4} queries'.format(name, endpoints[name]['median_ms'],
+                                     endpoints[name]['p95_ms'],
+                                     endpoints[name]['queries'])
+    return {
+        'generation_seconds': round(generation, 3),
+        'rows': rows,
+        'endpoints': endpoints,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark OSPFM endpoints on a generated dataset. '
+                    'ALL TABLES OF THE GIVEN DATABASES ARE DROPPED.'
+    )
+    parser.add_argument('--users', type=int, default=5)
+    parser.add_argument('--accounts', type=int, default=5,
+                        help='accounts per user')
+    parser.add_argument('--categories', type=int, default=30,
+                        help='categories per user')
+    parser.add_argument('--depth', type=int, default=3,
+                        help='depth of the categories trees')
+    parser.add_argument('--transactions', type=int, default=2000,
+                        help='transactions per user')
+    parser.add_argument('--splits', type=int, default=3,
+                        help='maximum number of categories per transaction')
+    parser.add_argument('--repeat', type=int, default=20,
+                        help='requests per endpoint')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--sqlite', default=os.path.join(
+                                                tempfile.gettempdir(),
+                                                'ospfm-benchmark.sqlite3'),
+                        help='SQLite database file')
+    parser.add_argument('--postgresql',
+                        help='URL of an empty PostgreSQL database')
+    parser.add_argument('--output', default='benchmark-report.json',
+                        help='JSON report file')
+    options = parser.parse_args()
+    options.depth = max(min(options.depth, options.categories), 1)
+
+    databases = [('sqlite', 'sqlite:///' + os.path.abspath(options.sqlite))]
+    if options.postgresql:
+        databases.append(('postgresql', options.postgresql))
+    report = {
+        'date': datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'run': str(uuid.uuid4()),
+        'python': platform.python_version(),
+        'sqlalchemy': sqlalchemy.__version__,
+        'parameters': dict([
+            (name, getattr(options, name)) for name in (
+                'users', 'accounts', 'categories', 'depth', 'transactions',
+                'splits', 'repeat', 'seed'
+            )
+        ]),
+        'databases': {},
+    }
+    for name, url in databases:
+        report['databases'][name] = benchmark(url, options)
+    with open(options.output, 'w') as output:
+        json.dump(report, output, indent=2, sort_keys=True)
+    print 'Report written to {0}'.format(options.output)
+
+if __name__ == '__main__':
+    main()
@@ -20,9 +20,12 @@
 
 import datetime, sys
 
+from sqlalchemy.engine.reflection import Inspector
+
 from ospfm import db, init_db
 
 from ospfm.core import models as core
+from ospfm.transaction import balance, closure, rollup
 from ospfm.transaction import models as transaction
 
 def populate_test_db():
@@ -252,7 +255,86 @@ def populate_currencies():
     ))
     db.session.commit()
 
+def verify_balances():
+    """Report accounts whose running balance drifted from their history"""
+    drifts = balance.verify_accounts()
+    for accountid, stored, stored_count, computed, computed_count in drifts:
+        print 'Account {0}: stored {1} ({2} transactions), ' \
+              'calculated {3} ({4} transactions)'.format(
+                    accountid, stored, stored_count, computed, computed_count
+              )
+    if drifts:
+        print '{0} drifted balance(s), run "{1} rebuildbalances"'.format(
+                    len(drifts), sys.argv[0]
+              )
+        return 1
+    print 'All accounts balances are correct'
+    return 0
+
+def rebuild_balances():
+    """Rebuild all accounts running balances from their history"""
+    count = balance.rebuild_accounts()
+    db.session.commit()
+    print '{0} accounts balances rebuilt'.format(count)
+    return 0
+
+def rebuild_categories():
+    """Rebuild the categories tree (closure table) from the parent links"""
+    count = closure.rebuild()
+    db.session.commit()
+    print '{0} categories placed in the tree'.format(count)
+    return 0
+
+def build_rollups():
+    """Build the daily totals from the transactions, in batches of days"""
+    transaction.CategoryDailyTotal.query.delete()
+    db.session.commit()
+    built = 0
+    first, last = rollup.history()
+    if first:
+        for batchfirst, batchlast in rollup.batches(first, last):
+            built += rollup.rebuild(first=batchfirst, last=batchlast)
+            db.session.commit()
+            print 'Daily totals built up to {0}'.format(batchlast)
+    print '{0} daily totals built'.format(built)
+    return 0
+
+def upgrade():
+    """
+    Bring an existing database up to date: add the missing indexes, then fill
+    the tables derived from the data (accounts running balances, categories
+    tree and daily totals). Missing tables have already been created.
+    """
+    # Missing tables have already been created by init_db
+    inspector = Inspector.from_engine(db.engine)
+    created = 0
+    for table in db.metadata.sorted_tables:
+        existing = [ i['name'] for i in inspector.get_indexes(table.name) ]
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(bind=db.engine)
+                print 'Index {0} created'.format(index.name)
+                created += 1
+    print '{0} indexes created'.format(created)
+    # Existing accounts have no running balance yet, existing categories are
+    # not in the tree and existing transactions are not in the daily totals
+    return rebuild_balances() or rebuild_categories() or build_rollups()
+
+# Maintenance commands, working on an existing database
+maintenance_commands = {
+    'verifybalances': verify_balances,
+    'rebuildbalances': rebuild_balances,
+    'rebuildcategories': rebuild_categories,
+    'buildrollups': build_rollups,
+    'upgrade': upgrade,
+}
+
 if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] in maintenance_commands:
+        # Only create missing tables
+        init_db()
+        sys.exit(maintenance_commands[sys.argv[1]]())
+
     init_db()
 
     populate_currencies()
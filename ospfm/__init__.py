@@ -18,13 +18,22 @@
 ########## App initialisation
 
 from flask import Flask
-from flask.ext.sqlalchemy import SQLAlchemy
 
 from ospfm import config
+from ospfm.database import RoutingSQLAlchemy
 
 app = Flask(__name__)
 app.config['SQLALCHEMY_DATABASE_URI'] = config.DATABASE
-db = SQLAlchemy(app)
+app.config['SQLALCHEMY_POOL_SIZE'] = getattr(config, 'DATABASE_POOL_SIZE', None)
+app.config['SQLALCHEMY_MAX_OVERFLOW'] = getattr(config,
+                                                'DATABASE_POOL_MAX_OVERFLOW',
+                                                None)
+app.config['SQLALCHEMY_POOL_TIMEOUT'] = getattr(config,
+                                                'DATABASE_POOL_TIMEOUT', None)
+app.config['SQLALCHEMY_POOL_RECYCLE'] = getattr(config,
+                                                'DATABASE_POOL_RECYCLE', None)
+db = RoutingSQLAlchemy(app, getattr(config, 'DATABASE_REPLICAS', []),
+                       getattr(config, 'DATABASE_POOL_PRE_PING', False))
 
 ########## App routing, etc
 
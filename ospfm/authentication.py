@@ -15,17 +15,26 @@
 #    You should have received a copy of the GNU Affero General Public License
 #    along with OSPFM.  If not, see <http://www.gnu.org/licenses/>.
 
+import base64
+import hashlib
+import hmac
+import threading
+import time
 import uuid
 
-from passlib.hash import sha512_crypt
+from flask import abort, after_this_request, g, jsonify, request
 
-from flask import abort, jsonify, request
-
-from ospfm import config
+from ospfm import config, passwords
 from ospfm.core import models as core
 
 cache = config.CACHE
 
+# Validity of API keys, in seconds
+KEY_LIFETIME = 1800
+# Keys are refreshed (their validity is extended) only when their remaining
+# validity is below this value, in seconds
+KEY_REFRESH = KEY_LIFETIME / 2
+
 # First, authenticate the user with a username and password
 # Next, authenticate API access with an API key, which is valid during 1 hour
 # API keys are UUIDs v4. UUIDs v4 collision is very unlikely, so we may rely
@@ -39,6 +48,112 @@ cache = config.CACHE
 # etc), users will be disconnected.
 #
 # Moving to a database storage is not excluded.
+#
+# The cache stores the username and the time the key was last refreshed: the
+# key is only re-set in cache when its remaining validity is below
+# KEY_REFRESH, not at each request.
+#
+# Each worker counts key hits, misses and refreshes in "key_counters".
+#
+#
+# Signed keys
+#
+# If SIGNED_KEYS_SECRET is defined in the configuration, keys are not stored in
+# cache anymore: they contain the username and their expiry date, signed with
+# an HMAC over the username, the remote IP address and the expiry date. Any
+# worker sharing the secret validates them in memory.
+#
+# When more than half of its lifetime has passed, a new key is given in the
+# "X-OSPFM-Key" response header : clients should use it for next requests.
+#
+# Signed keys cannot be deleted : keys revoked before their expiry (see
+# "/logout") are in a small deny-list, stored in cache. Each worker keeps a
+# copy of this deny-list and refreshes it from the cache at most every
+# DENYLIST_REFRESH seconds.
+
+SIGNED_KEYS_SECRET = getattr(config, 'SIGNED_KEYS_SECRET', None)
+DENYLIST_KEY = 'denied-keys'
+DENYLIST_REFRESH = getattr(config, 'SIGNED_KEYS_DENYLIST_REFRESH', 10)
+
+key_counters = {'hits': 0, 'misses': 0, 'refreshes': 0}
+__counters_lock = threading.Lock()
+
+__denylist = {'keys': {}, 'loaded': 0}
+__denylist_lock = threading.Lock()
+
+def __count(counter):
+    with __counters_lock:
+        key_counters[counter] += 1
+
+def __signature(username, remote_addr, expiry):
+    return hmac.new(
+        SIGNED_KEYS_SECRET,
+        '\0'.join((username.encode('utf8'), remote_addr, str(expiry))),
+        hashlib.sha256
+    ).hexdigest()
+
+def signed_key(username, remote_addr, expiry=None):
+    """Return a signed key for this user"""
+    if expiry is None:
+        expiry = int(time.time()) + KEY_LIFETIME
+    return '{0}.{1}.{2}'.format(
+        base64.urlsafe_b64encode(username.encode('utf8')),
+        expiry,
+        __signature(username, remote_addr, expiry)
+    )
+
+def __signed_key_data(key, remote_addr):
+    """
+    Return (username, expiry) if the key is valid for this remote address,
+    None otherwise
+    """
+    try:
+        username, expiry, signature = key.split('.')
+        username = base64.urlsafe_b64decode(str(username)).decode('utf8')
+        expiry = int(expiry)
+    except (ValueError, TypeError, UnicodeError):
+        return None
+    if expiry < time.time() or not hmac.compare_digest(
+                        str(signature),
+                        __signature(username, remote_addr, expiry)
+                   ):
+        return None
+    if signature in __denied_keys():
+        return None
+    return username, expiry
+
+def __denied_keys():
+    """Return the deny-list, refreshed from the cache if needed"""
+    with __denylist_lock:
+        if time.time() - __denylist['loaded'] > DENYLIST_REFRESH:
+            __denylist['keys'] = cache.get(DENYLIST_KEY) or {}
+            __denylist['loaded'] = time.time()
+        return __denylist['keys']
+
+def revoke(key):
+    """Revoke a key before its expiry"""
+    if SIGNED_KEYS_SECRET:
+        data = __signed_key_data(key, request.remote_addr)
+        if data:
+            now = int(time.time())
+            signature = key.split('.')[2]
+            # Forget keys which have expired anyway
+            denied = dict([
+                (sig, expiry) for sig, expiry
+                in (cache.get(DENYLIST_KEY) or {}).items()
+                if expiry > now
+            ])
+            denied[signature] = data[1]
+            cache.set(DENYLIST_KEY, denied, KEY_LIFETIME)
+            with __denylist_lock:
+                __denylist['keys'] = denied
+                __denylist['loaded'] = time.time()
+    elif key:
+        cache.delete(request.remote_addr+'---'+key)
+
+def logout():
+    revoke(request.headers.get('Authorization', None))
+    return jsonify(status=200, response='OK')
 
 def authenticate(username=None, password=None, http_abort=True):
     if not username:
@@ -67,11 +182,15 @@ def authenticate(username=None, password=None, http_abort=True):
             # self.forbidden('Wrong username or password')
         else:
             return False
-    if sha512_crypt.verify(password, user.passhash):
+    if passwords.verify(password, user.passhash):
         # Last login was not a fail, remove the fail info in the cache
         cache.delete(request.remote_addr+'-'+username+'-authfails')
-        key = str(uuid.uuid4())
-        cache.set(request.remote_addr+'---'+key, username, 1800)
+        if SIGNED_KEYS_SECRET:
+            key = signed_key(username, request.remote_addr)
+        else:
+            key = str(uuid.uuid4())
+            cache.set(request.remote_addr+'---'+key,
+                      (username, int(time.time())), KEY_LIFETIME)
         return jsonify(status=200, response={'key': key})
     elif http_abort:
         # Minimal protection against passwords guess attempts: each login
@@ -82,12 +201,42 @@ def authenticate(username=None, password=None, http_abort=True):
         return False
 
 def get_username_auth(key):
-        if key:
-            username = cache.get(request.remote_addr+'---'+key)
-            if username:
-                # Extend the key validity, 30 more minutes
-                cache.set(request.remote_addr+'---'+key, username, 1800)
+        # Already authenticated (batch requests, see ospfm.batch)
+        if getattr(g, 'ospfm_username', None):
+            return g.ospfm_username
+        if key and SIGNED_KEYS_SECRET:
+            data = __signed_key_data(key, request.remote_addr)
+            if data:
+                __count('hits')
+                username, expiry = data
+                # Give a new key when half of the validity has passed
+                if expiry - time.time() < KEY_REFRESH:
+                    __count('refreshes')
+                    newkey = signed_key(username, request.remote_addr)
+                    @after_this_request
+                    def reissue(response):
+                        response.headers['X-OSPFM-Key'] = newkey
+                        return response
+                return username
+            __count('misses')
+        elif key:
+            data = cache.get(request.remote_addr+'---'+key)
+            if data:
+                __count('hits')
+                # Keys stored before refresh times were stored only contain
+                # the username
+                if isinstance(data, tuple):
+                    username, refreshed = data
+                else:
+                    username, refreshed = data, 0
+                now = int(time.time())
+                if refreshed + KEY_LIFETIME - now < KEY_REFRESH:
+                    # Extend the key validity, 30 more minutes
+                    __count('refreshes')
+                    cache.set(request.remote_addr+'---'+key,
+                              (username, now), KEY_LIFETIME)
                 return username
+            __count('misses')
         if config.DEVEL and config.DEVEL_USERNAME:
             return config.DEVEL_USERNAME
         abort(401, 'Please login')
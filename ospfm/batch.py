@@ -0,0 +1,107 @@
+#    Copyright 2012-2013 Sebastien Maccagnoni-Munch
+#
+#    This file is part of OSPFM.
+#
+#    OSPFM is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    OSPFM is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with OSPFM.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import sys
+
+from flask import abort, g, jsonify, request
+from werkzeug.exceptions import HTTPException
+
+from ospfm import app, authentication, db, errorpages
+
+# Maximum number of requests in a batch
+BATCH_MAX_REQUESTS = 50
+# Endpoints which cannot be batched (their responses are not JSON objects)
+BATCH_EXCLUDED_ENDPOINTS = ('batch', 'metrics', 'root', 'static',
+                            'transaction_export')
+
+
+@app.route('/batch', methods=['POST'])
+def batch():
+    """
+    Run several requests at once, with only one authentication and one
+    database session
+
+    All requests are checked before any of them is run: once they are run,
+    their errors are given in their own responses.
+    """
+    try:
+        requests = json.loads(request.values['requests'])
+    except (KeyError, ValueError):
+        abort(400, 'Please provide the requests')
+    if type(requests) != type([]) or len(requests) > BATCH_MAX_REQUESTS:
+        abort(400, 'Please provide a list of at most {0} requests'.format(
+                                                           BATCH_MAX_REQUESTS))
+    requests = [ check(subrequest) for subrequest in requests ]
+    # Measure the batch as a whole (see ospfm.metrics)
+    g.ospfm_handler = 'batch'
+    # Authenticate once for all requests (see authentication.get_username_auth)
+    g.ospfm_username = authentication.get_username_auth(
+                            request.headers.get('Authorization', None)
+                       )
+    return jsonify(status=200, response=[ run(method, url, data)
+                                          for method, url, data in requests ])
+
+
+def check(subrequest):
+    """Return the method, url and data of a request, abort if it is invalid"""
+    if type(subrequest) != type({}) or \
+       not isinstance(subrequest.get('url'), basestring):
+        abort(400, 'Each request must have an url')
+    method = unicode(subrequest.get('method', 'GET')).upper()
+    data = subrequest.get('data', {})
+    if method not in ('GET', 'POST', 'DELETE') or type(data) != type({}):
+        abort(400, 'This request cannot be batched')
+    # The URL is matched by the request context, whatever its form (unknown
+    # URLs are answered by their own 404 response)
+    with app.test_request_context(subrequest['url'], method=method):
+        if request.endpoint in BATCH_EXCLUDED_ENDPOINTS:
+            abort(400, 'This request cannot be batched')
+    return method, subrequest['url'], data
+
+
+def run(method, url, data):
+    """Run a checked request and return its JSON response"""
+    # The application context (and the database session) is shared with the
+    # batch request: only a new request context is created
+    authorization = request.headers.get('Authorization', '')
+    remote_addr = request.remote_addr
+    with app.test_request_context(
+        url, method=method, data=data,
+        headers={'Authorization': authorization},
+        environ_base={'REMOTE_ADDR': remote_addr}
+    ):
+        try:
+            response = app.make_response(app.dispatch_request())
+        except HTTPException, e:
+            response = app.make_response(app.handle_user_exception(e))
+        except Exception, e:
+            try:
+                # Errors with an error page (or raised again)
+                response = app.make_response(app.handle_user_exception(e))
+            except Exception:
+                # Other errors only fail this request
+                app.log_exception(sys.exc_info())
+                response = app.make_response(errorpages.error500(e))
+        if response.status_code >= 400:
+            # Do not leave a failed request's changes in the shared session
+            db.session.rollback()
+        try:
+            return json.loads(response.data)
+        except ValueError:
+            return {'status': 400, 'response': 'Bad request',
+                    'details': 'This request cannot be batched'}
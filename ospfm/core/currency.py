@@ -18,7 +18,7 @@
 from flask import abort, jsonify
 
 from ospfm import db, helpers
-from ospfm.core import models
+from ospfm.core import exchangerate, models
 from ospfm.transaction import models as transaction
 from ospfm.objects import Object
 
@@ -113,11 +113,20 @@ class Currency(Object):
         db.session.commit()
 
     def http_rate(self, fromisocode, toisocode):
-        response = helpers.rate(self.username, fromisocode, toisocode)
+        self._Object__init_http()
+        if 'date' in self.args:
+            on_date = helpers.date_from_string(self.args['date'])
+            if not on_date:
+                self.badrequest("This date cannot be understood")
+        else:
+            on_date = None
+        response = helpers.rate(self.username, fromisocode, toisocode,
+                                on_date)
         if response:
             return jsonify(
                         status=200,
-                        response=response
+                        response=response,
+                        age=exchangerate.age()
                 )
         else:
             self.badrequest("Rate cannot be calculated")
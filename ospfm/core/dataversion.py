@@ -0,0 +1,106 @@
+#    Copyright 2012-2013 Sebastien Maccagnoni-Munch
+#
+#    This file is part of OSPFM.
+#
+#    OSPFM is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    OSPFM is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with OSPFM.  If not, see <http://www.gnu.org/licenses/>.
+import datetime
+import hashlib
+
+from ospfm import config, db
+from ospfm.core import exchangerate, models
+from ospfm.transaction import models as transaction
+cache = config.CACHE
+
+# Each user has a data version, increased after each write which may modify
+# what this user reads (including writes on accounts shared with other users).
+#
+# It is used to build the ETag of GET responses: a client which already has
+# the current version of a response gets a "304 Not Modified" answer, without
+# any model query. Versions are read from the cache when possible.
+#
+# A version read from the database just before a concurrent bump may be put
+# in the cache after the bump has removed it: cached versions are only kept
+# VERSION_CACHE_TIMEOUT seconds, so such a stale version is soon forgotten.
+
+VERSION_KEY = 'data-version-{0}'
+VERSION_CACHE_TIMEOUT = 30
+
+def get(username, cached=True):
+    """
+    Return the data version of a user
+
+    If "cached" is False, the version is read with the current session, so it
+    matches the data this session reads (which may be served by a replica)
+    """
+    if not cached:
+        return db.session.query(models.DataVersion.version).filter(
+                    models.DataVersion.username == username
+               ).scalar() or 0
+    version = cache.get(VERSION_KEY.format(username))
+    if version is None:
+        version = db.session.query(models.DataVersion.version).filter(
+                        models.DataVersion.username == username
+                  ).scalar() or 0
+        # Never replace a version cached in the meantime
+        cache.add(VERSION_KEY.format(username), version,
+                  VERSION_CACHE_TIMEOUT)
+    return version
+
+def bump(username, others=()):
+    """
+    Increase the data version of a user, of all users sharing accounts with
+    this user and of "others" (users who shared accounts with this user before
+    the write), and commit it
+
+    Must be called after the write has been committed, so a new version always
+    means new data
+    """
+    usernames = set([username] + [ ao[0] for ao in db.session.query(
+        transaction.AccountOwner.owner_username
+    ).filter(
+        transaction.AccountOwner.account_id.in_(
+            db.session.query(transaction.AccountOwner.account_id).filter(
+                transaction.AccountOwner.owner_username == username
+            ).subquery()
+        )
+    ) ] + list(others))
+    existing = set([ v[0] for v in db.session.query(
+        models.DataVersion.username
+    ).filter(
+        models.DataVersion.username.in_(usernames)
+    ) ])
+    if existing:
+        models.DataVersion.query.filter(
+            models.DataVersion.username.in_(existing)
+        ).update({
+            models.DataVersion.version: models.DataVersion.version + 1
+        }, synchronize_session=False)
+    db.session.add_all([ models.DataVersion(username=u, version=1)
+                         for u in usernames - existing ])
+    db.session.commit()
+    # Only invalidate cached versions once the new ones are committed
+    for u in usernames:
+        cache.delete(VERSION_KEY.format(u))
+
+def etag(username, path, cached=True):
+    """
+    Return the ETag of a GET response: it also depends on the exchange rates
+    and on the current date (used by periods balances)
+
+    "cached" is given to "get"
+    """
+    return hashlib.md5('{0}|{1}|{2}|{3}|{4}'.format(
+        username.encode('utf8'), get(username, cached), path.encode('utf8'),
+        exchangerate.timestamp(), datetime.date.today()
+    )).hexdigest()
@@ -15,12 +15,17 @@
 #    You should have received a copy of the GNU Affero General Public License
 #    along with OSPFM.  If not, see <http://www.gnu.org/licenses/>.
 
+import calendar
+import datetime
+import threading
 import time
 import json
 import urllib
+from collections import OrderedDict
 from decimal import Decimal
 
-from ospfm import config
+from ospfm import config, db
+from ospfm.core import models
 cache = config.CACHE
 
 OPEN_EXCHANGE_RATES_LATEST_VALUES_URL = (
@@ -28,16 +33,185 @@ OPEN_EXCHANGE_RATES_LATEST_VALUES_URL = (
                                                    config.OPEN_EXCHANGE_APP_ID)
 )
 
-def getrate(from_currency, to_currency, amount='1'):
-    rates = cache.get('open-exchange-rates')
+# Rates are refreshed in the background when they are older than
+# RATES_REFRESH_AGE seconds: meanwhile, the last known rates are used. Only
+# one worker refreshes them at a time (the lock is a cache key, added
+# atomically). Rates are only fetched synchronously when there is no known
+# rate at all.
+#
+# The provider may be replaced (for instance by a local stub for tests) with
+# the EXCHANGE_RATES_PROVIDER configuration option: a function which returns
+# rates in the OpenExchangeRates format:
+#   { 'timestamp': <unix timestamp>, 'rates': { <isocode>: <rate>, ... } }
+#
+# Each fetched rates table is also stored in the database (one table per day,
+# models.ExchangeRate): they are used for conversions at a given date, and
+# when the provider cannot be reached.
+RATES_KEY = 'open-exchange-rates'
+RATES_LOCK_KEY = 'open-exchange-rates-lock'
+RATES_REFRESH_AGE = getattr(config, 'EXCHANGE_RATES_REFRESH_AGE', 3300)
+# Known rates are kept much longer than their refresh age, in order to be
+# used if the provider is not available
+RATES_KEEP = 7 * 24 * 3600
+# Maximum duration of a refresh, after which another worker may try again
+# (also the delay between two tries when the provider is not available)
+RATES_LOCK_TIMEOUT = 60
+# When no rate is known and another worker is fetching them, other workers
+# wait for them during at most RATES_WAIT seconds (checking the cache every
+# RATES_WAIT_STEP seconds)
+RATES_WAIT = 5
+RATES_WAIT_STEP = 0.2
+# Number of dates for which stored rates are kept in memory
+RATES_HISTORY_SIZE = 64
+
+__history = OrderedDict()
+__history_lock = threading.Lock()
+
+def openexchangerates():
+    """Fetch the latest rates from OpenExchangeRates"""
+    exchanges_json = urllib.urlopen(OPEN_EXCHANGE_RATES_LATEST_VALUES_URL)
+    rates = json.load(exchanges_json)
+    exchanges_json.close()
+    return rates
+
+def store(rates):
+    """Store a rates table in the database, as the table of its day"""
+    day = datetime.datetime.utcfromtimestamp(rates['timestamp']).date()
+    table = models.ExchangeRate.__table__
+    # Use a connection of its own: the session of the current request must
+    # not be committed here
+    with db.engine.begin() as connection:
+        connection.execute(table.delete().where(table.c.date == day))
+        connection.execute(table.insert(), [
+            {'date': day, 'isocode': isocode, 'rate': Decimal(str(rate))}
+            for isocode, rate in rates['rates'].items()
+        ])
+    with __history_lock:
+        __history.clear()
+
+def stored(on_date=None):
+    """
+    Return the most recent rates stored in the database (before or on
+    "on_date" if given), in the provider format, or None
+    """
+    query = db.session.query(db.func.max(models.ExchangeRate.date))
+    if on_date:
+        query = query.filter(models.ExchangeRate.date <= on_date)
+    day = query.scalar()
+    if not day:
+        return None
+    return {
+        'timestamp': calendar.timegm(day.timetuple()),
+        'rates': dict(
+            db.session.query(
+                models.ExchangeRate.isocode,
+                models.ExchangeRate.rate
+            ).filter(models.ExchangeRate.date == day)
+        )
+    }
+
+def in_background(function, *args):
+    """Run a function in a background thread, with an application context"""
+    def run():
+        from ospfm import app
+        with app.app_context():
+            try:
+                function(*args)
+            finally:
+                db.session.remove()
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+
+def refresh():
+    """Fetch rates from the provider, put them in the cache and store them"""
+    provider = getattr(config, 'EXCHANGE_RATES_PROVIDER', openexchangerates)
+    rates = provider()
+    # If the provider fails, the lock is kept until its timeout so it is not
+    # tried again by each request
+    cache.set(RATES_KEY, rates, RATES_KEEP)
+    cache.delete(RATES_LOCK_KEY)
+    # Storing does not slow down (nor lock the database of) the current request
+    in_background(store, rates)
+    return rates
+
+def age(rates=None):
+    """Return the age of the known rates, in seconds (None if unknown)"""
+    if rates is None:
+        rates = cache.get(RATES_KEY)
+    if not rates:
+        return None
+    return max(int(time.time()) - rates['timestamp'], 0)
+
+def timestamp():
+    """Return the timestamp of the known rates (None if unknown)"""
+    rates = cache.get(RATES_KEY)
+    if not rates:
+        return None
+    return rates['timestamp']
+
+def getrates():
+    """Return the known rates, refreshing them if needed"""
+    rates = cache.get(RATES_KEY)
+    if not rates:
+        if cache.add(RATES_LOCK_KEY, True, RATES_LOCK_TIMEOUT):
+            # Nothing to serve and this worker won the lock: fetch them now...
+            try:
+                return refresh()
+            except (IOError, ValueError):
+                # ... or use the last stored ones if the provider is
+                # unreachable
+                rates = stored()
+                if not rates:
+                    raise
+                cache.set(RATES_KEY, rates, RATES_KEEP)
+                return rates
+        # Another worker is fetching them: use the last stored ones...
+        rates = stored()
+        if rates:
+            return rates
+        # ... or wait for them
+        deadline = time.time() + RATES_WAIT
+        while time.time() < deadline:
+            time.sleep(RATES_WAIT_STEP)
+            rates = cache.get(RATES_KEY)
+            if rates:
+                return rates
+        raise IOError("Exchange rates are not available")
+    if age(rates) > RATES_REFRESH_AGE and \
+       cache.add(RATES_LOCK_KEY, True, RATES_LOCK_TIMEOUT):
+        # This worker won the lock: refresh in the background, the current
+        # rates are still served
+        in_background(refresh)
+    return rates
+
+def getrates_on(on_date):
+    """
+    Return the rates of a given date: the latest rates for today (or later),
+    the most recent rates stored on or before this date otherwise
+    """
+    if on_date >= datetime.datetime.utcnow().date():
+        return getrates()
+    with __history_lock:
+        if on_date in __history:
+            rates = __history.pop(on_date)
+            __history[on_date] = rates
+            return rates
+    rates = stored(on_date)
     if not rates:
-        exchanges_json = urllib.urlopen(OPEN_EXCHANGE_RATES_LATEST_VALUES_URL)
-        rates = json.load(exchanges_json)
-        exchanges_json.close()
-        # In order to have the most up-to-date rates from OpenExchangeRates,
-        # duration = 1 hour - (now - timestamp) + 10 seconds security window)
-        duration = 3600 - (int(time.time()) - rates['timestamp']) + 10
-        cache.set('open-exchange-rates', rates, duration)
+        # Nothing stored for this date, the latest rates are the best guess
+        return getrates()
+    with __history_lock:
+        __history[on_date] = rates
+        while len(__history) > RATES_HISTORY_SIZE:
+            __history.popitem(last=False)
+    return rates
+
+def getrate(from_currency, to_currency, amount='1', on_date=None):
+    if on_date:
+        rates = getrates_on(on_date)
+    else:
+        rates = getrates()
     # Using "Decimal(str(<value>))" in order to get exact results
     base_to_from = Decimal(str(rates['rates'][from_currency]))
     base_to_to = Decimal(str(rates['rates'][to_currency]))
@@ -33,6 +33,11 @@ class Currency(db.Model):
     name           = db.Column(db.String(50), nullable=False)
     rate           = db.Column(db.Numeric(16, 4))
 
+    __table_args__ = (
+        db.Index('ix_currency_isocode_owner', 'isocode', 'owner_username'),
+        db.Index('ix_currency_owner', 'owner_username'),
+    )
+
     def __unicode__(self):
         return u'Currency name "{0}", isocode "{1}", symbol "{2}", rate "{3}"'.format(
                         self.name, self.isocode, self.symbol, self.rate
@@ -52,6 +57,22 @@ class Currency(db.Model):
 
 
 
+class ExchangeRate(db.Model):
+    """
+    Rates fetched from the exchange rates provider, from its base currency
+    (see ospfm.core.exchangerate)
+    """
+    date    = db.Column(db.Date, primary_key=True)
+    isocode = db.Column(db.String(5), primary_key=True)
+    rate    = db.Column(db.Numeric(24, 12), nullable=False)
+
+    def __unicode__(self):
+        return u'Exchange rate on {0}, isocode "{1}", rate "{2}"'.format(
+                        self.date, self.isocode, self.rate
+                    )
+
+
+
 class User(db.Model):
     username              = db.Column(db.String(50), nullable=False,
                                       unique=True, primary_key=True)
@@ -86,6 +107,22 @@ class User(db.Model):
 
 
 
+class DataVersion(db.Model):
+    """
+    Version of a user's data, increased by each write (see
+    ospfm.core.dataversion)
+    """
+    username = db.Column(db.ForeignKey('user.username', onupdate='CASCADE',
+                                       ondelete='CASCADE'),
+                         primary_key=True)
+    version  = db.Column(db.Integer, nullable=False, default=0)
+
+    def __unicode__(self):
+        return u'Username "{0}", data version {1}'.format(self.username,
+                                                          self.version)
+
+
+
 class UserContact(db.Model):
     id               = db.Column(db.Integer, primary_key=True)
     user_username    = db.Column(db.ForeignKey('user.username',
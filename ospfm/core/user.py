@@ -18,16 +18,17 @@
 import json
 import os
 
-from passlib.hash import sha512_crypt
-
 from flask import jsonify
 
-from ospfm import authentication, config, db
+from ospfm import authentication, config, db, passwords
 from ospfm.core import exchangerate, models
 from ospfm.objects import Object
 
 class User(Object):
 
+    # Other users modify their own information
+    etag = False
+
     def list(self):
         # Users cannot be listed with the API
         self.forbidden("Listing all users is forbidden")
@@ -77,10 +78,7 @@ class User(Object):
                     if len(self.args['password']) < 8:
                         self.badrequest(
                                'Password should be at least 8 characters long')
-                    user.passhash = sha512_crypt.encrypt(
-                                        self.args['password'],
-                                        rounds=config.PASSWORD_SALT_COMPLEXITY
-                                    )
+                    user.passhash = passwords.encrypt(self.args['password'])
                 else:
                     self.badrequest(
                                  "Please provide the correct current password")
@@ -213,6 +211,8 @@ class User(Object):
 class UserContact(Object):
 
     emptyvalid = ['comment']
+    # Contacts show information modified by other users
+    etag = False
 
     def list(self):
         contacts = models.UserContact.query.options(
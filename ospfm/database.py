@@ -0,0 +1,143 @@
+#    Copyright 2012-2013 Sebastien Maccagnoni-Munch
+#
+#    This file is part of OSPFM.
+#
+#    OSPFM is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    OSPFM is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with OSPFM.  If not, see <http://www.gnu.org/licenses/>.
+import random
+import threading
+import time
+
+from flask.ext.sqlalchemy import SQLAlchemy, SignallingSession, get_state
+from sqlalchemy import event, exc
+from sqlalchemy.pool import QueuePool
+
+# Read replicas
+#
+# DATABASE_REPLICAS is a list of database URIs of read-only replicas of the
+# main database. They are declared as Flask-SQLAlchemy binds (named
+# "replica-0", "replica-1", etc), so they share the engine configuration of
+# the main database.
+#
+# Each session (one per request) picks a replica. Its queries are sent to the
+# replica only after "use_replica()" has been called (by GET requests, see
+# ospfm.objects) and until "use_primary()" is called. Flushes are always sent
+# to the main database.
+#
+# Replicas may lag a little behind the main database: responses to writes and
+# their additional data are always computed from the main database.
+
+REPLICA_BIND = 'replica-{0}'
+
+# Connection pools
+#
+# Pools of the main database and of the replicas are configured by the
+# DATABASE_POOL_* configuration keys (see ospfm.config.py.template). Except for
+# SQLite, they are MeasuredQueuePools, which keep statistics for ospfm.metrics.
+#
+# With DATABASE_POOL_PRE_PING, connections are tested when taken from the
+# pool: a connection closed by the database server is replaced by a new one
+# instead of failing the request.
+
+
+class MeasuredQueuePool(QueuePool):
+    """
+    Connections pool counting checkouts, the time spent waiting for a
+    connection and invalidated connections
+    """
+
+    def __init__(self, creator, ping_on_checkout=False, **kw):
+        QueuePool.__init__(self, creator, **kw)
+        self.stats = {'checkouts': 0, 'wait_time': 0.0, 'invalidations': 0}
+        self.stats_lock = threading.Lock()
+        # Recreated pools (after a disconnection) keep the listeners
+        if '_dispatch' not in kw:
+            event.listen(self, 'invalidate', self.__invalidated)
+            if ping_on_checkout:
+                event.listen(self, 'checkout', ping)
+
+    def recreate(self):
+        pool = QueuePool.recreate(self)
+        pool.stats = self.stats
+        pool.stats_lock = self.stats_lock
+        return pool
+
+    def _do_get(self):
+        start = time.time()
+        try:
+            return QueuePool._do_get(self)
+        finally:
+            with self.stats_lock:
+                self.stats['checkouts'] += 1
+                self.stats['wait_time'] += time.time() - start
+
+    def __invalidated(self, dbapi_connection, connection_record, exception):
+        with self.stats_lock:
+            self.stats['invalidations'] += 1
+
+
+def ping(dbapi_connection, connection_record, connection_proxy):
+    """Test a connection taken from the pool"""
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute('SELECT 1')
+    except Exception:
+        # The pool will retry with a new connection
+        raise exc.DisconnectionError()
+    finally:
+        cursor.close()
+
+
+class RoutingSession(SignallingSession):
+    """Session sending its queries to a replica when asked to"""
+
+    def __init__(self, db, replicas=(), **options):
+        SignallingSession.__init__(self, db, **options)
+        self.replica = random.choice(replicas) if replicas else None
+        self.replica_reads = False
+
+    def get_bind(self, mapper=None, clause=None):
+        if self.replica_reads and self.replica and not self._flushing:
+            return get_state(self.app).db.get_engine(self.app,
+                                                     bind=self.replica)
+        return SignallingSession.get_bind(self, mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """Flask-SQLAlchemy extension with read replicas"""
+
+    def __init__(self, app, replicas=(), pre_ping=False):
+        self.pre_ping = pre_ping
+        self.replicas = [ REPLICA_BIND.format(number)
+                          for number in range(len(replicas)) ]
+        binds = app.config.setdefault('SQLALCHEMY_BINDS', {})
+        for name, uri in zip(self.replicas, replicas):
+            binds[name] = uri
+        SQLAlchemy.__init__(self, app)
+
+    def apply_driver_hacks(self, app, info, options):
+        SQLAlchemy.apply_driver_hacks(self, app, info, options)
+        if 'poolclass' not in options and info.drivername != 'sqlite':
+            options['poolclass'] = MeasuredQueuePool
+            options['ping_on_checkout'] = self.pre_ping
+
+    def create_session(self, options):
+        return RoutingSession(self, replicas=self.replicas, **options)
+
+    def use_replica(self):
+        """Send the next queries of the current session to a replica"""
+        self.session().replica_reads = True
+
+    def use_primary(self):
+        """Send the next queries of the current session to the main database"""
+        self.session().replica_reads = False
@@ -69,6 +69,16 @@ def error405(e):
     response.status_code = 405
     return response
 
+@app.errorhandler(503)
+def error503(e):
+    if e.description:
+        response = jsonify(status=503, response='Service unavailable',
+                           details=e.description)
+    else:
+        response = jsonify(status=503, response='Service unavailable')
+    response.status_code = 503
+    return response
+
 @app.errorhandler(500)
 def error500(e):
     response = jsonify(status=500, response='Server Error')
@@ -17,7 +17,7 @@
 
 import datetime
 
-from flask import request
+from flask import g, has_app_context, request
 
 from ospfm import config, db
 from ospfm.core import exchangerate
@@ -36,51 +36,111 @@ def date_from_string(string):
             pass
     return None
 
-def rate(username, fromisocode, toisocode):
-    if fromisocode == toisocode:
-        return 1
-    # Request the currencies
-    fromcurrency = core.Currency.query.filter(
-        db.and_(
-            core.Currency.isocode == fromisocode,
-            db.or_(
-                core.Currency.owner_username == username,
-                core.Currency.owner_username == None,
-            )
-        )
-    ).first()
-    tocurrency = core.Currency.query.filter(
-        db.and_(
-            core.Currency.isocode == toisocode,
+def __rates_context(username):
+    """
+    Return the rates context of a user for the current request:
+        {
+            'currencies': { <isocode>: <user-defined rate or None>, ... },
+            'preferred': <preferred currency isocode>,
+            'pairs': { (<from isocode>, <to isocode>, <date>): <rate>, ... }
+        }
+
+    It is kept on flask.g, so currencies and rates are only resolved once per
+    request (outside of a request, a new context is returned on each call)
+    """
+    if has_app_context():
+        contexts = getattr(g, 'ospfm_rates', None)
+        if contexts is None:
+            contexts = g.ospfm_rates = {}
+    else:
+        contexts = {}
+    if username not in contexts:
+        contexts[username] = {'currencies': None, 'preferred': None,
+                              'pairs': {}}
+    return contexts[username]
+
+def reset_rates():
+    """
+    Forget the rates context of the current request
+
+    Must be called after writes which may modify currencies or rates
+    """
+    if has_app_context():
+        g.ospfm_rates = {}
+
+def currencies(username):
+    """
+    Return the currencies available to a user, with their user-defined rates:
+        { <isocode>: <user-defined rate or None>, ... }
+    """
+    context = __rates_context(username)
+    if context['currencies'] is None:
+        available = {}
+        # Global currencies first, so they are overridden by user's currencies
+        for isocode, rate, owner in db.session.query(
+            core.Currency.isocode,
+            core.Currency.rate,
+            core.Currency.owner_username
+        ).filter(
             db.or_(
                 core.Currency.owner_username == username,
                 core.Currency.owner_username == None,
             )
-        )
-    ).first()
-    if not fromcurrency or not tocurrency:
+        ).order_by(core.Currency.owner_username != None):
+            available[isocode] = rate
+        context['currencies'] = available
+    return context['currencies']
+
+def preferred_isocode(username):
+    """Return the isocode of a user's preferred currency"""
+    context = __rates_context(username)
+    if context['preferred'] is None:
+        context['preferred'] = db.session.query(core.Currency.isocode).join(
+            core.User, core.User.preferred_currency_id == core.Currency.id
+        ).filter(core.User.username == username).scalar()
+    return context['preferred']
+
+def rate(username, fromisocode, toisocode, on_date=None):
+    """
+    Return the rate from a currency to another one, for a user
+
+    If "on_date" is given, globally defined currencies are converted with the
+    rates of this date
+    """
+    if fromisocode == toisocode:
+        return 1
+    pairs = __rates_context(username)['pairs']
+    key = (fromisocode, toisocode, on_date)
+    if key not in pairs:
+        pairs[key] = __rate(username, fromisocode, toisocode, on_date)
+    return pairs[key]
+
+def __rate(username, fromisocode, toisocode, on_date):
+    # Resolve the currencies
+    available = currencies(username)
+    if fromisocode not in available or toisocode not in available:
         return None
+    fromrate = available[fromisocode]
+    torate = available[toisocode]
     # Both currencies are globally defined
-    if (fromcurrency.rate is None) and (tocurrency.rate is None):
-        return exchangerate.getrate(fromcurrency.isocode, tocurrency.isocode)
+    if (fromrate is None) and (torate is None):
+        return exchangerate.getrate(fromisocode, toisocode, on_date=on_date)
     # Both currencies are user-defined
-    elif (fromcurrency.rate is not None) and (tocurrency.rate is not None):
-        return tocurrency.rate / fromcurrency.rate
+    elif (fromrate is not None) and (torate is not None):
+        return torate / fromrate
     # Mixed user-defined / globally defined rates
     else:
-        preferred_isocode = core.User.query.filter(
-                                core.User.username==username
-                           ).one().preferred_currency.isocode
+        preferred = preferred_isocode(username)
         # From a user-defined currency to a globally defined currency
-        if (fromcurrency.rate is not None) and (tocurrency.rate is None):
-            target_rate = exchangerate.getrate(preferred_isocode,
-                                               tocurrency.isocode)
-            if (fromcurrency.rate == 0):
+        if (fromrate is not None) and (torate is None):
+            target_rate = exchangerate.getrate(preferred, toisocode,
+                                               on_date=on_date)
+            if (fromrate == 0):
                 return 0
-            return target_rate / fromcurrency.rate
-        if (fromcurrency.rate is None) and (tocurrency.rate is not None):
-            source_rate = exchangerate.getrate(preferred_isocode,
-                                               fromcurrency.isocode)
-            if (tocurrency.rate == 0):
+            return target_rate / fromrate
+        if (fromrate is None) and (torate is not None):
+            source_rate = exchangerate.getrate(preferred, fromisocode,
+                                               on_date=on_date)
+            if (torate == 0):
                 return 0
-            return tocurrency.rate / source_rate
+            return torate / source_rate
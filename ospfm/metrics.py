@@ -0,0 +1,268 @@
+#    Copyright 2012-2013 Sebastien Maccagnoni-Munch
+#
+#    This file is part of OSPFM.
+#
+#    OSPFM is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    OSPFM is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with OSPFM.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+import time
+
+from flask import Response, abort, g, has_app_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from ospfm import app, authentication, config, db
+
+# Metrics, in the Prometheus text format, on "/metrics"
+#
+# Each worker process has its own metrics: counters start again from 0 when a
+# worker is restarted. Only addresses in METRICS_ALLOWED_ADDRESSES may read
+# them.
+#
+# Metrics are either counters, increased with "inc()", histograms, updated
+# with "observe()", or computed when they are read by functions registered
+# with "@collector" (which return a list of (name, labels, value)). Metrics
+# types and descriptions are declared with "describe()".
+
+METRICS_ALLOWED_ADDRESSES = getattr(config, 'METRICS_ALLOWED_ADDRESSES',
+                                    ['127.0.0.1'])
+
+__descriptions = {}
+__counters = {}
+__counters_lock = threading.Lock()
+__collectors = []
+
+
+def describe(name, type, description):
+    """Declare the type ("counter" or "gauge") and description of a metric"""
+    __descriptions[name] = (type, description)
+
+
+def inc(name, value=1, **labels):
+    """Increase a counter"""
+    key = (name, tuple(sorted(labels.items())))
+    with __counters_lock:
+        __counters[key] = __counters.get(key, 0) + value
+
+
+def observe(name, value, buckets, **labels):
+    """Add a value to a histogram"""
+    labels = tuple(sorted(labels.items()))
+    with __counters_lock:
+        # Buckets are cumulative, and all of them are given (even empty ones)
+        for bucket in list(buckets) + ['+Inf']:
+            key = (name+'_bucket', labels + (('le', bucket),))
+            if bucket == '+Inf' or value <= bucket:
+                __counters[key] = __counters.get(key, 0) + 1
+            else:
+                __counters[key] = __counters.get(key, 0)
+        __counters[(name+'_sum', labels)] = \
+                                  __counters.get((name+'_sum', labels), 0) + value
+        __counters[(name+'_count', labels)] = \
+                                  __counters.get((name+'_count', labels), 0) + 1
+
+
+def __family(name):
+    """Return the name of the metric a value belongs to"""
+    for suffix in ('_bucket', '_sum', '_count'):
+        base = name[:-len(suffix)]
+        if name.endswith(suffix) and \
+           __descriptions.get(base, (None,))[0] == 'histogram':
+            return base
+    return name
+
+
+def collector(function):
+    """Register a function computing metrics when they are read"""
+    __collectors.append(function)
+    return function
+
+
+def __order(metric):
+    """Sort key of a value: histogram buckets in numeric order, "+Inf" last"""
+    name, labels, value = metric
+    return (
+        name,
+        [ label for label in labels if label[0] != 'le' ],
+        [ float(labelvalue) for label, labelvalue in labels if label == 'le' ]
+    )
+
+
+def __format(name, labels, value):
+    if labels:
+        return '{0}{{{1}}} {2}'.format(
+            name,
+            ','.join([ '{0}="{1}"'.format(label, str(labelvalue).replace(
+                                        '\\', '\\\\').replace('"', '\\"'))
+                       for label, labelvalue in labels ]),
+            repr(float(value))
+        )
+    return '{0} {1}'.format(name, repr(float(value)))
+
+
+def render():
+    """Return all metrics in the Prometheus text format"""
+    with __counters_lock:
+        metrics = [ (name, labels, value) for (name, labels), value
+                    in __counters.items() ]
+    for function in __collectors:
+        metrics.extend([ (name, tuple(sorted(labels.items())), value)
+                         for name, labels, value in function() ])
+    lines = []
+    for family in sorted(set([ __family(metric[0]) for metric in metrics ])):
+        if family in __descriptions:
+            lines.append('# HELP {0} {1}'.format(family,
+                                                 __descriptions[family][1]))
+            lines.append('# TYPE {0} {1}'.format(family,
+                                                 __descriptions[family][0]))
+        lines.extend([ __format(*metric) for metric in sorted(
+                           [ metric for metric in metrics
+                             if __family(metric[0]) == family ],
+                           key=__order
+                       ) ])
+    return '\n'.join(lines) + '\n'
+
+
+@app.route('/metrics')
+def metrics():
+    if request.remote_addr not in METRICS_ALLOWED_ADDRESSES:
+        abort(403)
+    return Response(render(), mimetype='text/plain; version=0.0.4')
+
+
+########## Requests
+
+# SQL statements are counted during each request. When config.DEVEL is set,
+# the number of statements of a request is given in the "X-OSPFM-Queries"
+# response header.
+
+REQUEST_DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5,
+                            5, 10)
+RESPONSE_SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+
+describe('ospfm_requests_total', 'counter', 'Requests')
+describe('ospfm_sql_statements_total', 'counter',
+         'SQL statements executed by requests')
+describe('ospfm_sql_seconds_total', 'counter',
+         'Time spent executing SQL statements in requests')
+describe('ospfm_request_duration_seconds', 'histogram',
+         'Duration of requests')
+describe('ospfm_response_size_bytes', 'histogram',
+         'Size of responses (streamed responses excluded)')
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def before_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    conn.info.setdefault('ospfm_query_start', []).append(time.time())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def after_cursor_execute(conn, cursor, statement, parameters, context,
+                         executemany):
+    start = conn.info['ospfm_query_start'].pop()
+    # Only statements run by requests are counted (not background jobs)
+    if has_app_context() and getattr(g, 'ospfm_sql', None) is not None:
+        g.ospfm_sql['count'] += 1
+        g.ospfm_sql['time'] += time.time() - start
+
+
+@event.listens_for(Engine, 'handle_error')
+def handle_error(context):
+    # "after_cursor_execute" is not called for failed statements
+    if context.connection is not None:
+        starts = context.connection.info.get('ospfm_query_start')
+        if starts:
+            starts.pop()
+
+
+@app.before_request
+def start_request():
+    g.ospfm_request_start = time.time()
+    g.ospfm_sql = {'count': 0, 'time': 0.0}
+
+
+@app.after_request
+def end_request(response):
+    if getattr(g, 'ospfm_sql', None) is None:
+        return response
+    labels = {
+        'route': request.url_rule.rule if request.url_rule else 'none',
+        'method': request.method,
+        'handler': getattr(g, 'ospfm_handler', None) or 'none',
+    }
+    inc('ospfm_requests_total', status=response.status_code, **labels)
+    inc('ospfm_sql_statements_total', g.ospfm_sql['count'], **labels)
+    inc('ospfm_sql_seconds_total', g.ospfm_sql['time'], **labels)
+    observe('ospfm_request_duration_seconds',
+            time.time() - g.ospfm_request_start, REQUEST_DURATION_BUCKETS,
+            **labels)
+    if not response.is_streamed:
+        observe('ospfm_response_size_bytes', len(response.data),
+                RESPONSE_SIZE_BUCKETS, **labels)
+    if config.DEVEL:
+        response.headers['X-OSPFM-Queries'] = str(g.ospfm_sql['count'])
+    return response
+
+
+########## Database connections pools
+
+describe('ospfm_db_pool_checkouts_total', 'counter',
+         'Connections taken from the pool')
+describe('ospfm_db_pool_wait_seconds_total', 'counter',
+         'Time spent waiting for a connection from the pool')
+describe('ospfm_db_pool_invalidations_total', 'counter',
+         'Connections invalidated (closed by the server, errors...)')
+describe('ospfm_db_pool_checked_out', 'gauge',
+         'Connections currently in use')
+describe('ospfm_db_pool_overflow', 'gauge',
+         'Connections currently open above the pool size')
+describe('ospfm_db_pool_size', 'gauge', 'Size of the pool')
+
+
+@collector
+def pools():
+    values = []
+    for bind in [None] + db.replicas:
+        pool = db.get_engine(app, bind).pool
+        labels = {'database': bind or 'main'}
+        if hasattr(pool, 'stats'):
+            with pool.stats_lock:
+                stats = dict(pool.stats)
+            values.extend([
+                ('ospfm_db_pool_checkouts_total', labels, stats['checkouts']),
+                ('ospfm_db_pool_wait_seconds_total', labels,
+                 stats['wait_time']),
+                ('ospfm_db_pool_invalidations_total', labels,
+                 stats['invalidations']),
+            ])
+        if hasattr(pool, 'overflow'):
+            values.extend([
+                ('ospfm_db_pool_checked_out', labels, pool.checkedout()),
+                ('ospfm_db_pool_overflow', labels, max(pool.overflow(), 0)),
+                ('ospfm_db_pool_size', labels, pool.size()),
+            ])
+    return values
+
+
+########## API keys
+
+describe('ospfm_api_keys_total', 'counter',
+         'API keys checks (hits, misses) and refreshes')
+
+
+@collector
+def api_keys():
+    return [ ('ospfm_api_keys_total', {'result': result}, value)
+             for result, value in authentication.key_counters.items() ]
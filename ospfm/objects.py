@@ -15,11 +15,12 @@
 #    You should have received a copy of the GNU Affero General Public License
 #    along with OSPFM.  If not, see <http://www.gnu.org/licenses/>.
 
-from flask import abort, jsonify, request
+from flask import abort, g, jsonify, make_response, request
 from sqlalchemy.exc import StatementError
 
 import ospfm
-from ospfm import authentication, db
+from ospfm import authentication, db, helpers
+from ospfm.core import dataversion
 
 class Object:
     """
@@ -34,12 +35,18 @@ class Object:
 
     ... self.args should be set to the args, especially for the "create" and
     "update" methods
+
+    ... GET responses get an ETag (see ospfm.core.dataversion) unless "etag"
+    is False: objects showing data other users modify must disable it
     """
     emptyvalid = []
+    etag = True
 
     def __init__(self, **kwargs):
         self.args = kwargs
         self.add_data = []
+        # Users whose data version must be increased too (see "http_request")
+        self.former_owners = set()
         # Empty values are forbidden if they are not in emptyvalid
         for item in self.args.items():
             if item[1] == '' and item[0] not in self.emptyvalid:
@@ -51,9 +58,43 @@ class Object:
                             request.headers.get('Authorization', None)
                         )
 
+    def __handler(self, method):
+        """Record the method handling the request (see ospfm.metrics)"""
+        if not getattr(g, 'ospfm_handler', None):
+            g.ospfm_handler = '{0}.{1}'.format(self.__class__.__name__, method)
+
     def add_to_response(self, *args):
-        """Adds an additional data to the response"""
-        self.add_data.append(args)
+        """Adds an additional data to the response (only once)"""
+        if args not in self.add_data:
+            self.add_data.append(args)
+
+    def __additional_data(self):
+        """
+        Compute all additional data in one pass
+
+        Additional methods with a "coalesce" attribute are called only once,
+        with the arguments of all their requests. Heavy computations are shared
+        between additional methods through the "shared" dictionary.
+        """
+        calls = []
+        coalesced = {}
+        for data in self.add_data:
+            method = ospfm.additional_methods[data[0]]
+            if getattr(method, 'coalesce', False):
+                if data[0] not in coalesced:
+                    coalesced[data[0]] = [data[0]]
+                    calls.append(coalesced[data[0]])
+                coalesced[data[0]].extend(data[1:])
+            else:
+                calls.append(list(data))
+        shared = {}
+        return [
+            [
+                call[0],
+                ospfm.additional_methods[call[0]](self.username, *call[1:],
+                                                  shared=shared)
+            ] for call in calls
+        ]
 
     def http_request(self, arg=None):
         """Deal with all HTTP requests"""
@@ -62,35 +103,64 @@ class Object:
         try:
             # Execute the request
             if request.method == 'GET':
-                if arg:
-                    response = self.read(arg)
-                else:
-                    response = self.list()
+                # Reads may be served by a replica (see ospfm.database)
+                db.use_replica()
+                try:
+                    # Nothing to compute if the client already has this
+                    # version. A replica may lag behind the main database
+                    # (and the cache): the version is then read on the
+                    # replica, before the data, so it is never newer.
+                    if self.etag:
+                        etag = dataversion.etag(
+                                    self.username, request.full_path,
+                                    cached=db.session().replica is None
+                               )
+                    else:
+                        etag = None
+                    if etag and etag in request.if_none_match:
+                        response = make_response('', 304)
+                        response.set_etag(etag)
+                        return response
+                    if arg:
+                        self.__handler('read')
+                        response = self.read(arg)
+                    else:
+                        self.__handler('list')
+                        response = self.list()
+                    additional_data = self.__additional_data()
+                finally:
+                    db.use_primary()
             elif request.method == 'POST':
                 if '_method' in self.args and self.args['_method'] == 'delete':
+                    self.__handler('delete')
                     self.delete(arg)
                     response = 'OK Deleted'
                 else:
                     if arg:
+                        self.__handler('update')
                         response = self.update(arg)
                     else:
+                        self.__handler('create')
                         response = self.create()
             elif request.method == 'DELETE':
+                self.__handler('delete')
                 self.delete(arg)
                 response = 'OK Deleted'
-            # Create additional data
-            additional_data = []
-            for data in self.add_data:
-                additional_data.append([
-                    data[0],
-                    ospfm.additional_methods[data[0]](self.username, *data[1:])
-                ])
+            if request.method != 'GET':
+                # Currencies or rates may have been modified
+                helpers.reset_rates()
+                dataversion.bump(self.username, self.former_owners)
+                # Create additional data, from the main database
+                additional_data = self.__additional_data()
             # JSON response
             if additional_data:
-                return jsonify(status=200, response=response,
-                               additional=additional_data)
+                response = jsonify(status=200, response=response,
+                                   additional=additional_data)
             else:
-                return jsonify(status=200, response=response)
+                response = jsonify(status=200, response=response)
+            if request.method == 'GET' and etag:
+                response.set_etag(etag)
+            return response
         except StatementError:
             db.session.rollback()
             self.badrequest("Database error")
@@ -0,0 +1,79 @@
+#    Copyright 2012-2013 Sebastien Maccagnoni-Munch
+#
+#    This file is part of OSPFM.
+#
+#    OSPFM is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    OSPFM is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with OSPFM.  If not, see <http://www.gnu.org/licenses/>.
+import multiprocessing
+import os
+import threading
+
+from passlib.hash import sha512_crypt
+
+from flask import abort
+
+from ospfm import config
+
+# Password hashes are verified and created by a pool of processes, so
+# hashing (which is slow on purpose) does not keep WSGI workers busy.
+#
+# PASSWORD_WORKERS is the number of processes of the pool (0 to hash in the
+# current process), PASSWORD_QUEUE the maximum number of hashing operations
+# running or waiting: over this limit, requests are rejected immediately with
+# a "503 Service Unavailable" error.
+PASSWORD_WORKERS = getattr(config, 'PASSWORD_WORKERS', 2)
+PASSWORD_QUEUE = getattr(config, 'PASSWORD_QUEUE', 8)
+# Maximum duration of an operation, in seconds
+PASSWORD_TIMEOUT = 30
+
+__pool = None
+__pool_pid = None
+__pool_lock = threading.Lock()
+__slots = threading.BoundedSemaphore(PASSWORD_QUEUE)
+
+def __verify(password, passhash):
+    return sha512_crypt.verify(password, passhash)
+
+def __encrypt(password, rounds):
+    return sha512_crypt.encrypt(password, rounds=rounds)
+
+def __get_pool():
+    """Return the pool of this process (created after forks)"""
+    global __pool, __pool_pid
+    with __pool_lock:
+        if __pool is None or __pool_pid != os.getpid():
+            __pool = multiprocessing.Pool(PASSWORD_WORKERS)
+            __pool_pid = os.getpid()
+        return __pool
+
+def __run(function, *args):
+    if not __slots.acquire(False):
+        abort(503, 'Too many password operations, please retry later')
+    try:
+        if PASSWORD_WORKERS:
+            try:
+                return __get_pool().apply_async(function, args).get(
+                                                              PASSWORD_TIMEOUT)
+            except multiprocessing.TimeoutError:
+                abort(503, 'Password operation too slow, please retry later')
+        return function(*args)
+    finally:
+        __slots.release()
+
+def verify(password, passhash):
+    """Verify a password against its hash"""
+    return __run(__verify, password, passhash)
+
+def encrypt(password):
+    """Return the hash of a password"""
+    return __run(__encrypt, password, config.PASSWORD_SALT_COMPLEXITY)
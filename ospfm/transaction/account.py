@@ -17,10 +17,10 @@
 
 from decimal import Decimal
 
-from ospfm import db, helpers
+from ospfm import db
 from ospfm.core import models as core
 from ospfm.core import currency as corecurrency
-from ospfm.transaction import models
+from ospfm.transaction import balance, models
 from ospfm.objects import Object
 
 
@@ -28,7 +28,8 @@ class Account(Object):
 
     def __own_account(self, accountid):
         return models.Account.query.options(
-                        db.joinedload(models.Account.currency)
+                        db.joinedload(models.Account.currency),
+                        db.joinedload(models.Account.running_balance)
                 ).join(models.AccountOwner).filter(
                     db.and_(
                         models.AccountOwner.owner_username == self.username,
@@ -42,20 +43,17 @@ class Account(Object):
         ).join(models.AccountOwner).filter(
             models.AccountOwner.owner_username == self.username
         ).all()
+        balances = balance.accounts_balances(self.username)
         # Calculate the total balance, in the user's preferred currency
-        totalbalance = 0
         totalcurrency = core.User.query.options(
                             db.joinedload(core.User.preferred_currency)
                         ).get(self.username).preferred_currency
-        for account in accounts:
-            totalbalance += account.balance(self.username)[0] * \
-            helpers.rate(self.username,
-                         account.currency.isocode,
-                         totalcurrency.isocode)
         return {
-            'accounts': [a.as_dict(self.username) for a in accounts],
+            'accounts': [a.as_dict(self.username, balances=balances[a.id]) \
+                                                            for a in accounts],
             'total': {
-                'balance': totalbalance,
+                'balance': sum([b['balance_preferred'] \
+                                                   for b in balances.values()]),
                 'currency': totalcurrency.isocode
             }
         }
@@ -89,7 +87,9 @@ class Account(Object):
                 start_balance=start_balance
         )
         ao = models.AccountOwner(account=a, owner_username=self.username)
-        db.session.add_all((a, ao))
+        ab = models.AccountBalance(account=a, balance=start_balance,
+                                   transactions_count=0)
+        db.session.add_all((a, ao, ab))
         db.session.commit()
         self.add_to_response('totalbalance')
         return a.as_dict(self.username)
@@ -124,7 +124,10 @@ class Account(Object):
                 if currency:
                     account.currency = currency
         if 'start_balance' in self.args:
-            account.start_balance = Decimal(self.args['start_balance'])
+            start_balance = Decimal(self.args['start_balance'])
+            difference = start_balance - account.start_balance
+            account.start_balance = start_balance
+            balance.update_account(account.id, difference, 0)
             self.add_to_response('totalbalance')
         db.session.commit()
         return account.as_dict(self.username)
@@ -134,6 +137,14 @@ class Account(Object):
         if not account:
             self.notfound(
                 'Nonexistent account cannot be deleted (or you do not own it)')
+        # Other owners must see the account disappear
+        self.former_owners.update([ ao.owner_username for ao in \
+            models.AccountOwner.query.filter(
+                db.and_(
+                    models.AccountOwner.account_id == account.id,
+                    models.AccountOwner.owner_username != self.username
+                )
+            ) ])
         db.session.delete(account)
         db.session.commit()
         self.add_to_response('totalbalance')
@@ -15,57 +15,66 @@
 #    You should have received a copy of the GNU Affero General Public License
 #    along with OSPFM.  If not, see <http://www.gnu.org/licenses/>.
 
-from ospfm import db, helpers
-from ospfm.transaction import models
-from ospfm.core import models as core
+from ospfm import helpers
+from ospfm.transaction import balance, closure
 
-def accountbalance(username, accountid):
-    account = models.Account.query.join(models.AccountOwner).filter(
-                    db.and_(
-                        models.AccountOwner.owner_username == username,
-                        models.Account.id == accountid
-                    )
-              ).first()
-    balances = account.balance(username)
+def __shared(shared, name, function, *args):
+    """Only compute once the data shared by several additional methods"""
+    if shared is None:
+        return function(*args)
+    if name not in shared:
+        shared[name] = function(*args)
+    return shared[name]
+
+def __ids(ids):
+    """Convert ids given by clients to integers (None if impossible)"""
+    converted = []
+    for objectid in ids:
+        try:
+            converted.append(int(objectid))
+        except (TypeError, ValueError):
+            converted.append(None)
+    return converted
+
+def accountbalance(username, accountid, shared=None):
+    balances = __shared(shared, 'accounts', balance.accounts_balances,
+                        username).get(__ids([accountid])[0])
+    if not balances:
+        # Not an account of this user
+        return None
     return {
         'id': accountid,
-        'balance': balances[0],
-        'balance_preferred': balances[1],
-        'transactions_count': account.transactions_count()
+        'balance': balances['balance'],
+        'balance_preferred': balances['balance_preferred'],
+        'transactions_count': balances['transactions_count']
     }
 
-def totalbalance(username):
-    accounts = models.Account.query.options(
-                    db.joinedload(models.Account.currency)
-    ).join(models.AccountOwner).filter(
-        models.AccountOwner.owner_username == username
-    ).all()
+def totalbalance(username, shared=None):
     # Calculate the total balance, in the user's preferred currency
-    totalbalance = 0
-    totalcurrency = core.User.query.options(
-                        db.joinedload(core.User.preferred_currency)
-                    ).get(username).preferred_currency
-    for account in accounts:
-        totalbalance += account.balance(username)[0] * \
-        helpers.rate(username,
-                     account.currency.isocode,
-                     totalcurrency.isocode)
     return {
-        'balance': totalbalance,
-        'currency': totalcurrency.isocode
+        'balance': sum([b['balance_preferred'] for b in __shared(
+                            shared, 'accounts', balance.accounts_balances,
+                            username
+                        ).values()]),
+        'currency': helpers.preferred_isocode(username)
     }
 
-def categoriesbalance(username, categoryid):
-    category = models.Category.query.filter(
-                    db.and_(
-                        models.Category.owner_username == username,
-                        models.Category.id == categoryid
-                    )
-              ).first()
-    balances = category.balance(username)
-    balances['id'] = categoryid
-    result = [ balances ]
-    # Also return parent category/ies balance(s)
-    if category.parent_id:
-        result.extend(categoriesbalance(username, category.parent_id))
+def categoriesbalance(username, *categoryids, **kwargs):
+    balances = __shared(kwargs.get('shared'), 'categories',
+                        balance.categories_balances, username)
+    categoryids = [ c for c in __ids(categoryids) if c is not None ]
+    ancestors = closure.ancestors_ids(categoryids)
+    result = []
+    returned = set()
+    # Also return parent category/ies balance(s), each one only once
+    for categoryid in categoryids:
+        for ancestorid in ancestors[categoryid]:
+            if ancestorid in returned or ancestorid not in balances:
+                continue
+            returned.add(ancestorid)
+            categorybalance = balances[ancestorid].copy()
+            categorybalance['id'] = ancestorid
+            result.append(categorybalance)
     return result
+# All requested categories are returned together
+categoriesbalance.coalesce = True
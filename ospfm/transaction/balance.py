@@ -0,0 +1,327 @@
+#    Copyright 2012-2013 Sebastien Maccagnoni-Munch
+#
+#    This file is part of OSPFM.
+#
+#    OSPFM is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    OSPFM is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with OSPFM.  If not, see <http://www.gnu.org/licenses/>.
+
+import datetime
+
+from ospfm import db, helpers
+from ospfm.core import models as core
+from ospfm.transaction import models
+
+# Accounts balances are not calculated from the whole history on each read:
+# a running balance (start balance included) and a transactions count are
+# stored for each account and updated in the same database transaction as
+# the write which modifies them.
+#
+# If they ever drift, they can be checked and rebuilt with:
+#
+#   python createdb.py verifybalances
+#   python createdb.py rebuildbalances
+#
+# Categories balances are calculated for all categories of a user at once,
+# summing all periods in one query over daily totals (see
+# ospfm.transaction.rollup); children are added to their parents in memory.
+
+
+def computed_accounts(username=None, accountids=None):
+    """
+    Calculate accounts balances from the whole history
+
+    Return a list of (<account id>, <balance>, <transactions count>), for all
+    accounts, for the accounts owned by the given user and/or for the given
+    accounts ids
+    """
+    query = db.session.query(
+        models.Account.id,
+        models.Account.start_balance,
+        db.func.sum(models.TransactionAccount.amount),
+        db.func.count(models.TransactionAccount.transaction_id)
+    ).outerjoin(
+        models.TransactionAccount,
+        models.TransactionAccount.account_id == models.Account.id
+    )
+    if username:
+        query = query.filter(
+            models.Account.id.in_(
+                db.session.query(models.AccountOwner.account_id).filter(
+                    models.AccountOwner.owner_username == username
+                )
+            )
+        )
+    if accountids is not None:
+        query = query.filter(models.Account.id.in_(accountids))
+    return [
+        (accountid, start_balance + (amount or 0), count)
+        for accountid, start_balance, amount, count in query.group_by(
+            models.Account.id, models.Account.start_balance
+        )
+    ]
+
+
+def rebuild_accounts(username=None, accountids=None):
+    """
+    Rebuild running balances from the whole history, for all accounts, for
+    the accounts owned by the given user and/or for the given accounts ids
+
+    The caller is responsible for committing the session.
+    """
+    if accountids is not None and not accountids:
+        return 0
+    computed = computed_accounts(username, accountids)
+    balances = models.AccountBalance.query
+    if username or accountids is not None:
+        if not computed:
+            return 0
+        balances = balances.filter(
+            models.AccountBalance.account_id.in_(
+                [accountid for accountid, balance, count in computed]
+            )
+        )
+    balances.delete(synchronize_session=False)
+    db.session.add_all([
+        models.AccountBalance(
+            account_id=accountid,
+            balance=balance,
+            transactions_count=count
+        ) for accountid, balance, count in computed
+    ])
+    db.session.flush()
+    return len(computed)
+
+
+def verify_accounts(username=None):
+    """
+    Compare running balances with balances calculated from the whole history
+
+    Return a list of (<account id>, <stored balance>, <stored count>,
+    <calculated balance>, <calculated count>) for each account which drifted
+    (stored values are None if the running balance does not exist)
+    """
+    stored = dict(
+        (b.account_id, (b.balance, b.transactions_count))
+        for b in models.AccountBalance.query
+    )
+    drifts = []
+    for accountid, balance, count in computed_accounts(username):
+        stored_balance, stored_count = stored.get(accountid, (None, None))
+        if stored_balance != balance or stored_count != count:
+            drifts.append(
+                (accountid, stored_balance, stored_count, balance, count)
+            )
+    return drifts
+
+
+def accounts_balances(username):
+    """
+    Return the balances of all accounts owned by a user:
+        {
+            <account id>: {
+                'balance': <balance in account currency>,
+                'balance_preferred': <balance in preferred currency>,
+                'transactions_count': <number of transactions>
+            },
+            ...
+        }
+
+    Running balances of all accounts are read at once
+    """
+    accounts = db.session.query(
+        models.Account.id,
+        core.Currency.isocode,
+        models.AccountBalance.balance,
+        models.AccountBalance.transactions_count
+    ).join(
+        models.AccountOwner
+    ).join(
+        core.Currency, models.Account.currency_id == core.Currency.id
+    ).outerjoin(
+        models.AccountBalance
+    ).filter(
+        models.AccountOwner.owner_username == username
+    ).all()
+    # Accounts without running balance yet are calculated in one grouped query
+    missing = [ a[0] for a in accounts if a[2] is None ]
+    computed = {}
+    if missing:
+        for accountid, balance, count in computed_accounts(accountids=missing):
+            computed[accountid] = (balance, count)
+    preferred_isocode = helpers.preferred_isocode(username)
+    balances = {}
+    for accountid, isocode, balance, count in accounts:
+        if balance is None:
+            balance, count = computed[accountid]
+        balances[accountid] = {
+            'balance': balance,
+            'balance_preferred': balance * helpers.rate(username, isocode,
+                                                        preferred_isocode),
+            'transactions_count': count
+        }
+    return balances
+
+
+def account_lines(transactionid):
+    """
+    Return the amounts of a transaction in its accounts, as a dictionary:
+        { <account id>: <amount>, ... }
+    """
+    return dict(
+        db.session.query(
+            models.TransactionAccount.account_id,
+            models.TransactionAccount.amount
+        ).filter(
+            models.TransactionAccount.transaction_id == transactionid
+        ).all()
+    )
+
+
+def update_account(accountid, amount, count):
+    """Add an amount and a number of transactions to a running balance"""
+    if not models.AccountBalance.query.filter(
+                models.AccountBalance.account_id == accountid
+           ).update({
+                models.AccountBalance.balance:
+                            models.AccountBalance.balance + amount,
+                models.AccountBalance.transactions_count:
+                            models.AccountBalance.transactions_count + count
+           }, synchronize_session=False):
+        # This account has no running balance yet: calculate it from the whole
+        # history, which already contains the modification
+        db.session.add_all([
+            models.AccountBalance(
+                account_id=accountid,
+                balance=balance,
+                transactions_count=count
+            ) for accountid, balance, count in computed_accounts(
+                                                      accountids=[accountid])
+        ])
+
+
+def update_accounts(before, after):
+    """
+    Update running balances, from the account lines of a transaction (see
+    account_lines) before and after it has been modified
+    """
+    for accountid in set(before.keys() + after.keys()):
+        amount = after.get(accountid, 0) - before.get(accountid, 0)
+        count = (accountid in after) - (accountid in before)
+        if amount or count:
+            update_account(accountid, amount, count)
+
+
+def periods(today=None):
+    """
+    Return the periods of categories balances:
+        [ (<period name>, <first day>, <last day>), ... ]
+    """
+    if not today:
+        today = datetime.date.today()
+    if today.month == 12:
+        lastdayofmonth = datetime.date(today.year, 12, 31)
+    else:
+        lastdayofmonth = datetime.date(today.year, today.month+1, 1) - \
+                                                          datetime.timedelta(1)
+    return [
+        ('year', datetime.date(today.year, 1, 1),
+                 datetime.date(today.year, 12, 31)),
+        ('month', datetime.date(today.year, today.month, 1), lastdayofmonth),
+        ('week', today - datetime.timedelta(today.weekday()),
+                 today + datetime.timedelta(6-today.weekday())),
+        ('7days', today - datetime.timedelta(6), today),
+        ('30days', today - datetime.timedelta(29), today)
+    ]
+
+
+def categories_balances(username, categories=None):
+    """
+    Return the balances of all categories of a user, including the balances
+    of their children (converted to their currency):
+        {
+            <category id>: {
+                'currency': <category currency isocode>,
+                'year': <balance>,
+                'month': <balance>,
+                'week': <balance>,
+                '7days': <balance>,
+                '30days': <balance>
+            },
+            ...
+        }
+
+    "categories" may be given if all the user's categories are already loaded
+    """
+    if categories is None:
+        categories = db.session.query(
+            models.Category.id,
+            models.Category.parent_id,
+            core.Currency.isocode
+        ).join(
+            core.Currency, models.Category.currency_id == core.Currency.id
+        ).filter(
+            models.Category.owner_username == username
+        ).all()
+    else:
+        categories = [ (c.id, c.parent_id, c.currency.isocode)
+                       for c in categories ]
+    allperiods = periods()
+
+    # Own balances of categories, all periods at once, from daily totals
+    own = {}
+    for row in db.session.query(
+        models.CategoryDailyTotal.category_id,
+        *[
+            db.func.sum(db.case(
+                [( models.CategoryDailyTotal.day.between(first, last),
+                   models.CategoryDailyTotal.amount )],
+                else_=0
+            )) for name, first, last in allperiods
+        ]
+    ).filter(
+        db.and_(
+            models.CategoryDailyTotal.owner_username == username,
+            models.CategoryDailyTotal.day.between(
+                min([ p[1] for p in allperiods ]),
+                max([ p[2] for p in allperiods ])
+            )
+        )
+    ).group_by(
+        models.CategoryDailyTotal.category_id
+    ):
+        own[row[0]] = row[1:]
+
+    # Add children balances to their parents
+    currencies = {}
+    children = {}
+    for categoryid, parentid, isocode in categories:
+        currencies[categoryid] = isocode
+        children.setdefault(parentid, []).append(categoryid)
+    balances = {}
+    def calculate(categoryid):
+        balance = {'currency': currencies[categoryid]}
+        amounts = own.get(categoryid, [ 0 ] * len(allperiods))
+        for period, amount in zip(allperiods, amounts):
+            balance[period[0]] = amount or 0
+        for childid in children.get(categoryid, []):
+            child = calculate(childid)
+            rate = helpers.rate(username, child['currency'],
+                                balance['currency'])
+            for period in allperiods:
+                balance[period[0]] = balance[period[0]] + \
+                                     child[period[0]] * rate
+        balances[categoryid] = balance
+        return balance
+    for categoryid in children.get(None, []):
+        calculate(categoryid)
+    return balances
@@ -15,10 +15,12 @@
 #    You should have received a copy of the GNU Affero General Public License
 #    along with OSPFM.  If not, see <http://www.gnu.org/licenses/>.
 
+from sqlalchemy.orm.attributes import set_committed_value
+
 from ospfm import db, helpers
 from ospfm.core import currency as currencylib
 from ospfm.core import models as core
-from ospfm.transaction import models
+from ospfm.transaction import balance, closure, models, rollup
 from ospfm.objects import Object
 
 
@@ -34,18 +36,39 @@ class Category(Object):
                     )
                ).first()
 
-    def list(self):
+    def __all_categories(self):
+        """
+        Return all categories of the user, with their children already
+        attached: walking through the tree does not need any more query
+        """
         categories = models.Category.query.order_by(
                         models.Category.name
                      ).options(
                         db.joinedload(models.Category.currency)
                      ).filter(
-                        db.and_(
-                            models.Category.owner_username == self.username,
-                            models.Category.parent_id == None
-                        )
+                        models.Category.owner_username == self.username
                      ).all()
-        return [c.as_dict(self.username) for c in categories]
+        children = {}
+        for category in categories:
+            children.setdefault(category.parent_id, []).append(category)
+        for category in categories:
+            set_committed_value(category, 'children',
+                                children.get(category.id, []))
+        return categories
+
+    def __as_dict(self, categoryid):
+        """Describe a category, with the balances of its tree"""
+        categories = self.__all_categories()
+        balances = balance.categories_balances(self.username, categories)
+        for category in categories:
+            if category.id == categoryid:
+                return category.as_dict(self.username, balances=balances)
+
+    def list(self):
+        categories = self.__all_categories()
+        balances = balance.categories_balances(self.username, categories)
+        return [c.as_dict(self.username, balances=balances) \
+                                         for c in categories if not c.parent_id]
 
     def create(self):
         if not ('currency' in self.args and 'name' in self.args):
@@ -74,13 +97,15 @@ class Category(Object):
                         name=self.args['name']
                    )
         db.session.add(category)
+        db.session.flush()
+        closure.add(category.id, category.parent_id)
         db.session.commit()
-        return category.as_dict(self.username)
+        return self.__as_dict(category.id)
 
     def read(self, categoryid):
         category = self.__own_category(categoryid)
         if category:
-            return category.as_dict(self.username)
+            return self.__as_dict(category.id)
         self.notfound('This category does not exist or you do not own it')
 
     def update(self, categoryid):
@@ -101,19 +126,29 @@ class Category(Object):
                 )
             ).first()
             if currency:
-                rate = helpers.rate(
-                            self.username,
-                            category.currency.isocode,
-                            currency.isocode
-                       )
-                category.currency = currency
-                for tc in models.TransactionCategory.query.filter(
+                # Each amount is converted with the rates of its transaction
+                # date (resolved once per date)
+                for tc, day in db.session.query(
+                            models.TransactionCategory,
+                            models.Transaction.date
+                          ).join(models.TransactionCategory.transaction
+                          ).filter(
                             models.TransactionCategory.category == category
                           ).all():
-                    tc.category_amount = tc.category_amount * rate
+                    tc.category_amount = tc.category_amount * helpers.rate(
+                                                    self.username,
+                                                    category.currency.isocode,
+                                                    currency.isocode,
+                                                    on_date=day
+                                                 )
+                category.currency = currency
+                # Daily totals are summed again from the converted amounts,
+                # rounded as they are stored
+                db.session.flush()
+                rollup.rebuild(categoryid=category.id)
         if 'parent' in self.args:
             if self.args['parent'] == 'NONE':
-                category.parent_id = None
+                parent = None
             else:
                 parent = self.__own_category(self.args['parent'])
                 if not parent:
@@ -121,22 +156,25 @@ class Category(Object):
                 if category.contains_category(parent.id):
                     self.badrequest(
                               "The parent is already a child of this category")
-                if parent.id != category.parent_id:
-                    allparents = set([parent.id, category.parent_id] + \
-                                     parent.all_parents_ids())
-                    if category.parent_id:
-                        allparents.update(category.parent.all_parents_ids())
-                    for parentid in allparents:
-                        if parentid:
-                            self.add_to_response('categoriesbalance', parentid)
-                    category.parent = parent
+            parentid = parent and parent.id or None
+            if parentid != category.parent_id:
+                # "categoriesbalance" also returns the balances of all the
+                # parents of the given category
+                for previousornext in (category.parent_id, parentid):
+                    if previousornext:
+                        self.add_to_response('categoriesbalance',
+                                             previousornext)
+                closure.move(category.id, parentid)
+                category.parent = parent
         db.session.commit()
-        return category.as_dict(self.username)
+        return self.__as_dict(category.id)
 
     def delete(self, categoryid):
         category = self.__own_category(categoryid)
         if not category:
             self.notfound(
                'Nonexistent category cannot be deleted (or you do not own it)')
+        closure.remove(category.id)
+        rollup.forget(category.id)
         db.session.delete(category)
         db.session.commit()
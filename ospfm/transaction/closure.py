@@ -0,0 +1,169 @@
+#    Copyright 2012-2013 Sebastien Maccagnoni-Munch
+#
+#    This file is part of OSPFM.
+#
+#    OSPFM is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    OSPFM is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with OSPFM.  If not, see <http://www.gnu.org/licenses/>.
+
+from ospfm import db
+from ospfm.transaction import models
+
+# The categories tree is stored as a closure table (models.CategoryClosure):
+# finding all descendants or all ancestors of a category only needs one query.
+#
+# It is kept in sync by the Category object (create, update, delete). It can
+# be rebuilt from the parent links with:
+#
+#   python createdb.py rebuildcategories
+
+
+def descendants_ids(categoryid):
+    """Return a query of the ids of a category and of all its descendants"""
+    return db.session.query(models.CategoryClosure.descendant_id).filter(
+                models.CategoryClosure.ancestor_id == categoryid
+           )
+
+
+def ancestors_ids(categoryids):
+    """
+    Return the ids of several categories and of all their ancestors, nearest
+    first, in one query:
+        { <category id>: [ <category id>, <parent id>, ... ], ... }
+    """
+    ancestors = dict([ (categoryid, []) for categoryid in categoryids ])
+    if categoryids:
+        for descendantid, ancestorid in db.session.query(
+            models.CategoryClosure.descendant_id,
+            models.CategoryClosure.ancestor_id
+        ).filter(
+            models.CategoryClosure.descendant_id.in_(categoryids)
+        ).order_by(models.CategoryClosure.depth):
+            ancestors[descendantid].append(ancestorid)
+    return ancestors
+
+
+def add(categoryid, parentid=None):
+    """Add a new category (without children) in the tree"""
+    links = [ models.CategoryClosure(ancestor_id=categoryid,
+                                     descendant_id=categoryid,
+                                     depth=0) ]
+    if parentid:
+        for ancestorid, depth in db.session.query(
+            models.CategoryClosure.ancestor_id,
+            models.CategoryClosure.depth
+        ).filter(
+            models.CategoryClosure.descendant_id == parentid
+        ):
+            links.append(models.CategoryClosure(ancestor_id=ancestorid,
+                                                descendant_id=categoryid,
+                                                depth=depth+1))
+    db.session.add_all(links)
+
+
+def move(categoryid, parentid=None):
+    """Move a category (with its descendants) under another parent"""
+    descendants = db.session.query(
+        models.CategoryClosure.descendant_id,
+        models.CategoryClosure.depth
+    ).filter(
+        models.CategoryClosure.ancestor_id == categoryid
+    ).all()
+    previous_ancestors = db.session.query(
+        models.CategoryClosure.ancestor_id
+    ).filter(
+        db.and_(
+            models.CategoryClosure.descendant_id == categoryid,
+            models.CategoryClosure.depth > 0
+        )
+    ).all()
+    # Detach the subtree from its previous ancestors...
+    if previous_ancestors:
+        models.CategoryClosure.query.filter(
+            db.and_(
+                models.CategoryClosure.descendant_id.in_(
+                    [ d[0] for d in descendants ]
+                ),
+                models.CategoryClosure.ancestor_id.in_(
+                    [ a[0] for a in previous_ancestors ]
+                )
+            )
+        ).delete(synchronize_session=False)
+    # ... and attach it to its new ancestors
+    if parentid:
+        ancestors = db.session.query(
+            models.CategoryClosure.ancestor_id,
+            models.CategoryClosure.depth
+        ).filter(
+            models.CategoryClosure.descendant_id == parentid
+        ).all()
+        db.session.add_all([
+            models.CategoryClosure(ancestor_id=ancestorid,
+                                   descendant_id=descendantid,
+                                   depth=ancestordepth+descendantdepth+1)
+            for ancestorid, ancestordepth in ancestors
+            for descendantid, descendantdepth in descendants
+        ])
+
+
+def remove(categoryid):
+    """
+    Remove a category from the tree: its children become root categories
+    (as their parent_id is set to NULL)
+    """
+    move(categoryid)
+    models.CategoryClosure.query.filter(
+        db.or_(
+            models.CategoryClosure.ancestor_id == categoryid,
+            models.CategoryClosure.descendant_id == categoryid
+        )
+    ).delete(synchronize_session=False)
+
+
+def rebuild(username=None):
+    """
+    Rebuild the tree from the parent links, for all categories or for the
+    categories of the given user
+
+    The caller is responsible for committing the session.
+    """
+    categories = db.session.query(models.Category.id,
+                                  models.Category.parent_id)
+    if username:
+        categories = categories.filter(
+            models.Category.owner_username == username
+        )
+    parents = dict(categories.all())
+    if not parents:
+        return 0
+    links = models.CategoryClosure.query
+    if username:
+        links = links.filter(
+            models.CategoryClosure.descendant_id.in_(parents.keys())
+        )
+    links.delete(synchronize_session=False)
+    for categoryid in parents:
+        ancestorid = categoryid
+        depth = 0
+        # Stop on loops, which would be an inconsistency in parent links
+        seen = set()
+        while ancestorid and ancestorid not in seen:
+            seen.add(ancestorid)
+            db.session.add(
+                models.CategoryClosure(ancestor_id=ancestorid,
+                                       descendant_id=categoryid,
+                                       depth=depth)
+            )
+            ancestorid = parents.get(ancestorid)
+            depth += 1
+    db.session.flush()
+    return len(parents)
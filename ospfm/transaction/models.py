@@ -16,13 +16,9 @@
 #    along with OSPFM.  If not, see <http://www.gnu.org/licenses/>.
 
 
-import datetime
-
-from ospfm import config, db, helpers
+from ospfm import db, helpers
 from ospfm.core import exchangerate, models as coremodels
 
-cache = config.CACHE
-
 
 
 class Account(db.Model):
@@ -44,36 +40,42 @@ class Account(db.Model):
         Return a list :
             [ <balance in account currency>, <balance in preferred currency> ]
         """
-        balance = db.session.query(
-            db.func.sum(TransactionAccount.amount)
-        ).filter(
-            TransactionAccount.account_id == self.id
-        ).one()[0]
-        if balance:
-            balances = [ self.start_balance + balance ]
+        if self.running_balance:
+            balances = [ self.running_balance.balance ]
         else:
-            balances = [ self.start_balance ]
+            # The running balance has not been built yet for this account
+            balance = db.session.query(
+                db.func.sum(TransactionAccount.amount)
+            ).filter(
+                TransactionAccount.account_id == self.id
+            ).one()[0]
+            if balance:
+                balances = [ self.start_balance + balance ]
+            else:
+                balances = [ self.start_balance ]
         balances.append(
             helpers.rate(
                 username,
                 self.currency.isocode,
-                coremodels.User.query.options(
-                    db.joinedload(coremodels.User.preferred_currency)
-                ).get(
-                    username
-                ).preferred_currency.isocode
+                helpers.preferred_isocode(username)
             ) * balances[0]
         )
         return balances
 
     def transactions_count(self):
+        if self.running_balance:
+            return self.running_balance.transactions_count
         return db.session.query(
             db.func.count(TransactionAccount.transaction_id)
         ).filter(
             TransactionAccount.account_id == self.id
         ).one()[0] or 0
 
-    def as_dict(self, username, short=False):
+    def as_dict(self, username, short=False, balances=None):
+        """
+        "balances" may be given when already known (see
+        ospfm.transaction.balance.accounts_balances)
+        """
         if short:
             return {
                 'id': self.id,
@@ -81,15 +83,21 @@ class Account(db.Model):
                 'currency': self.currency.isocode
             }
         else:
-            balances = self.balance(username)
+            if not balances:
+                balance = self.balance(username)
+                balances = {
+                    'balance': balance[0],
+                    'balance_preferred': balance[1],
+                    'transactions_count': self.transactions_count()
+                }
             return {
                 'id': self.id,
                 'name': self.name,
                 'currency': self.currency.isocode,
                 'start_balance': self.start_balance,
-                'balance': balances[0],
-                'balance_preferred': balances[1],
-                'transactions_count': self.transactions_count()
+                'balance': balances['balance'],
+                'balance_preferred': balances['balance_preferred'],
+                'transactions_count': balances['transactions_count']
             }
 
 
@@ -102,6 +110,10 @@ class AccountOwner(db.Model):
                                              ondelete='CASCADE'),
                                primary_key=True)
 
+    __table_args__ = (
+        db.Index('ix_account_owner_owner', 'owner_username', 'account_id'),
+    )
+
     account = db.relationship('Account', backref=db.backref(
                                                    'account_owners',
                                                    cascade="all, delete-orphan"
@@ -110,6 +122,31 @@ class AccountOwner(db.Model):
 
 
 
+class AccountBalance(db.Model):
+    """
+    Running balance of an account (start balance included) and number of
+    transactions in this account, maintained on each write (see
+    ospfm.transaction.balance)
+    """
+    account_id         = db.Column(db.ForeignKey('account.id',
+                                                 ondelete='CASCADE'),
+                                   primary_key=True)
+    balance            = db.Column(db.Numeric(15, 3), nullable=False)
+    transactions_count = db.Column(db.Integer, nullable=False, default=0)
+
+    account = db.relationship('Account', backref=db.backref(
+                                                   'running_balance',
+                                                   uselist=False,
+                                                   cascade="all, delete-orphan"
+                                                ))
+
+    def __unicode__(self):
+        return u'Account id {0}, balance {1}, {2} transactions'.format(
+                    self.account_id, self.balance, self.transactions_count
+                )
+
+
+
 class Category(db.Model):
     id             = db.Column(db.Integer, primary_key=True)
     owner_username = db.Column(db.ForeignKey('user.username',
@@ -122,6 +159,11 @@ class Category(db.Model):
                                              ondelete='CASCADE'))
     name           = db.Column(db.String(50), nullable=False)
 
+    __table_args__ = (
+        db.Index('ix_category_owner_parent', 'owner_username', 'parent_id'),
+        db.Index('ix_category_parent', 'parent_id'),
+    )
+
     currency = db.relationship('Currency')
 
     children = db.relationship('Category', order_by='Category.name',
@@ -135,134 +177,113 @@ class Category(db.Model):
         else:
             return u'Category id {0}, name "{1}"'.format(self.id, self.name)
 
-    def balance(self, username):
-        today = datetime.date.today()
-
-        balance = cache.get('categorybalance-{0}'.format(self.id))
-
-        if not balance:
-            balance = {'currency': self.currency.isocode}
-            balance['year'] = db.session.query(
-                db.func.sum(TransactionCategory.category_amount)
-            ).filter(
-                db.and_(
-                    TransactionCategory.category_id == self.id,
-                    TransactionCategory.transaction_id == Transaction.id,
-                    Transaction.date.between(
-                        datetime.date(today.year, 1, 1),
-                        datetime.date(today.year, 12, 31)
-                    )
-                )
-            ).one()[0] or 0
-
-            if today.month == 12:
-                lastdayofmonth = datetime.date(today.year, 12, 31)
-            else:
-                lastdayofmonth = datetime.date(today.year, today.month+1, 1) -\
-                                                          datetime.timedelta(1)
-            balance['month'] = db.session.query(
-                db.func.sum(TransactionCategory.category_amount)
-            ).filter(
-                db.and_(
-                    TransactionCategory.category_id == self.id,
-                    TransactionCategory.transaction_id == Transaction.id,
-                    Transaction.date.between(
-                        datetime.date(today.year, today.month, 1),
-                        lastdayofmonth
-                    )
-                )
-            ).one()[0] or 0
-
-            firstdayofweek = today - datetime.timedelta(today.weekday())
-            lastdayofweek = today + datetime.timedelta(6-today.weekday())
-            balance['week'] = db.session.query(
-                db.func.sum(TransactionCategory.category_amount)
-            ).filter(
-                db.and_(
-                    TransactionCategory.category_id == self.id,
-                    TransactionCategory.transaction_id == Transaction.id,
-                    Transaction.date.between(
-                        firstdayofweek,
-                        lastdayofweek
-                    )
-                )
-            ).one()[0] or 0
-
-            balance['7days'] = db.session.query(
-                db.func.sum(TransactionCategory.category_amount)
-            ).filter(
-                db.and_(
-                    TransactionCategory.category_id == self.id,
-                    TransactionCategory.transaction_id == Transaction.id,
-                    Transaction.date.between(
-                        today - datetime.timedelta(6),
-                        today
-                    )
-                )
-            ).one()[0] or 0
-
-            balance['30days'] = db.session.query(
-                db.func.sum(TransactionCategory.category_amount)
-            ).filter(
-                db.and_(
-                    TransactionCategory.category_id == self.id,
-                    TransactionCategory.transaction_id == Transaction.id,
-                    Transaction.date.between(
-                        today - datetime.timedelta(29),
-                        today
-                    )
-                )
-            ).one()[0] or 0
-
-            # Cache the balance only for 5 seconds : it helps when listing
-            # multiple categories by reducing sql requests
-            cache.set('categorybalance-{0}'.format(self.id), balance, 5)
-
-        for child in self.children:
-            child_balance = child.balance(username)
-            rate = helpers.rate(username,
-                              child_balance['currency'], self.currency.isocode)
-            balance['year'] = balance['year'] + child_balance['year'] * rate
-            balance['month'] = balance['month'] + child_balance['month'] * rate
-            balance['week'] = balance['week'] + child_balance['week'] * rate
-            balance['7days'] = balance['7days'] + child_balance['7days'] * rate
-            balance['30days'] = balance['30days'] +child_balance['30days']*rate
-
-        return balance
-
     def all_parents_ids(self):
-        parents = []
-        if self.parent_id:
-            parents.append(self.parent_id)
-            parents = parents + self.parent.all_parents_ids()
-        return parents
+        """Return the ids of all parents, from the nearest to the root"""
+        return [ c.ancestor_id for c in CategoryClosure.query.filter(
+                    db.and_(
+                        CategoryClosure.descendant_id == self.id,
+                        CategoryClosure.depth > 0
+                    )
+                 ).order_by(CategoryClosure.depth) ]
 
     def contains_category(self, categoryid):
         if self.id == categoryid:
             return True
-        if self.children:
-            for c in self.children:
-                if c.contains_category(categoryid):
-                    return True
+        # Links from this category to itself and to the other category
+        links = CategoryClosure.query.filter(
+                    db.and_(
+                        CategoryClosure.ancestor_id == self.id,
+                        CategoryClosure.descendant_id.in_(
+                                                       [self.id, categoryid])
+                    )
+                ).count()
+        if links:
+            return links > 1
+        # The tree has not been built (see ospfm.transaction.closure): walk
+        # up the parents of the other category instead
+        seen = set()
+        while categoryid and categoryid not in seen:
+            if categoryid == self.id:
+                return True
+            seen.add(categoryid)
+            categoryid = db.session.query(Category.parent_id).filter(
+                            Category.id == categoryid
+                         ).scalar()
         return False
 
-    def as_dict(self, username, parent=True, children=True, balance=True):
+    def as_dict(self, username, parent=True, children=True, balances=None):
+        """
+        "balances" are the balances of all the user's categories (see
+        ospfm.transaction.balance.categories_balances), when they are needed
+        """
         desc = {
             'id': self.id,
             'name': self.name,
             'currency': self.currency.isocode,
         }
-        if balance:
-            desc.update(self.balance(username))
+        if balances is not None:
+            desc.update(balances[self.id])
         if parent and self.parent_id:
             desc['parent'] = self.parent_id
         if children and self.children:
-            desc['children'] = [c.as_dict(username, False) \
+            desc['children'] = [c.as_dict(username, False, balances=balances) \
                                                         for c in self.children]
         return desc
 
 
 
+class CategoryClosure(db.Model):
+    """
+    Closure of the categories tree: one row for each category and each of its
+    ancestors, including itself with depth 0 (maintained by
+    ospfm.transaction.closure)
+    """
+    ancestor_id   = db.Column(db.ForeignKey('category.id', ondelete='CASCADE'),
+                              primary_key=True)
+    descendant_id = db.Column(db.ForeignKey('category.id', ondelete='CASCADE'),
+                              primary_key=True)
+    depth         = db.Column(db.Integer, nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_category_closure_descendant', 'descendant_id', 'depth'),
+    )
+
+    def __unicode__(self):
+        return u'Category id {0} is an ancestor of category id {1}, ' \
+               u'depth {2}'.format(
+                    self.ancestor_id, self.descendant_id, self.depth
+                )
+
+
+
+class CategoryDailyTotal(db.Model):
+    """
+    Sum and number of the transactions of a category on one day, maintained on
+    each write (see ospfm.transaction.rollup)
+    """
+    category_id        = db.Column(db.ForeignKey('category.id',
+                                                 ondelete='CASCADE'),
+                                   primary_key=True)
+    day                = db.Column(db.Date, primary_key=True)
+    owner_username     = db.Column(db.ForeignKey('user.username',
+                                                 onupdate='CASCADE',
+                                                 ondelete='CASCADE'),
+                                   nullable=False)
+    amount             = db.Column(db.Numeric(15, 3), nullable=False)
+    transactions_count = db.Column(db.Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        db.Index('ix_category_daily_total_owner_day', 'owner_username', 'day'),
+    )
+
+    def __unicode__(self):
+        return u'Category id {0}, day {1}, amount {2}, {3} transactions'.format(
+                    self.category_id, self.day, self.amount,
+                    self.transactions_count
+                )
+
+
+
 class Transaction(db.Model):
     id                   = db.Column(db.Integer, primary_key=True)
     owner_username       = db.Column(db.ForeignKey('user.username',
@@ -277,6 +298,12 @@ class Transaction(db.Model):
                                      nullable=False)
     date                 = db.Column(db.Date, nullable=False)
 
+    __table_args__ = (
+        # Transactions are listed by owner, most recent first (an index can
+        # be read backwards, so ascending order is fine)
+        db.Index('ix_transaction_owner_date', 'owner_username', 'date', 'id'),
+    )
+
     currency = db.relationship('Currency')
 
     def as_dict(self, username):
@@ -304,6 +331,11 @@ class TransactionAccount(db.Model):
     amount         = db.Column(db.Numeric(15, 3), nullable=False)
     verified       = db.Column(db.Boolean, nullable=False, default=False)
 
+    __table_args__ = (
+        db.Index('ix_transaction_account_account', 'account_id',
+                 'transaction_id'),
+    )
+
     account = db.relationship('Account')
     transaction = db.relationship('Transaction', backref=db.backref(
                                                   'transaction_accounts',
@@ -331,6 +363,11 @@ class TransactionCategory(db.Model):
     transaction_amount = db.Column(db.Numeric(15, 3), nullable=False)
     category_amount    = db.Column(db.Numeric(15, 3), nullable=False)
 
+    __table_args__ = (
+        db.Index('ix_transaction_category_category', 'category_id',
+                 'transaction_id'),
+    )
+
     category = db.relationship('Category')
     transaction = db.relationship('Transaction', backref=db.backref(
                                                    'transaction_categories',
@@ -339,7 +376,7 @@ class TransactionCategory(db.Model):
 
     def as_dict(self, username):
         data = self.category.as_dict(username, parent=False,
-                                     children=False,balance=False)
+                                     children=False)
         data['transaction_amount'] = self.transaction_amount
         data['category_amount'] = self.category_amount
         return data
@@ -0,0 +1,183 @@
+#    Copyright 2012-2013 Sebastien Maccagnoni-Munch
+#
+#    This file is part of OSPFM.
+#
+#    OSPFM is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    OSPFM is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with OSPFM.  If not, see <http://www.gnu.org/licenses/>.
+
+import datetime
+
+from ospfm import db
+from ospfm.transaction import models
+
+# Transactions are summed by day for each category
+# (models.CategoryDailyTotal): period balances are sums over at most a few
+# hundred daily rows instead of the whole history. Accounts do not need them:
+# their balances are kept up to date (see ospfm.transaction.balance).
+#
+# Daily totals are updated in the same database transaction as the write which
+# modifies them. They have to be built once for existing data, and can be
+# rebuilt at any time, with:
+#
+#   python createdb.py buildrollups
+
+
+def lines(transactionid):
+    """
+    Return the amounts of a transaction in its categories:
+        { (<category id>, <day>): <amount>, ... }
+    """
+    return dict(
+        ((categoryid, day), amount) for categoryid, day, amount in \
+        db.session.query(
+            models.TransactionCategory.category_id,
+            models.Transaction.date,
+            models.TransactionCategory.category_amount
+        ).join(
+            models.Transaction,
+            models.TransactionCategory.transaction_id == models.Transaction.id
+        ).filter(
+            models.Transaction.id == transactionid
+        )
+    )
+
+
+def update_total(categoryid, day, amount, count):
+    """Add an amount and a number of transactions to a daily total"""
+    model = models.CategoryDailyTotal
+    total = db.and_(model.category_id == categoryid, model.day == day)
+    if not model.query.filter(total).update({
+                model.amount: model.amount + amount,
+                model.transactions_count: model.transactions_count + count
+           }, synchronize_session=False):
+        if count > 0:
+            db.session.add(model(
+                category_id=categoryid,
+                day=day,
+                owner_username=db.session.query(
+                    models.Category.owner_username
+                ).filter(models.Category.id == categoryid).scalar(),
+                amount=amount,
+                transactions_count=count
+            ))
+    elif count < 0:
+        # Do not keep days without any transaction
+        model.query.filter(
+            db.and_(total, model.transactions_count <= 0)
+        ).delete(synchronize_session=False)
+
+
+def update(before, after):
+    """
+    Update daily totals, from the lines of a transaction (see lines) before and
+    after it has been modified
+    """
+    for key in set(before.keys() + after.keys()):
+        amount = after.get(key, 0) - before.get(key, 0)
+        count = (key in after) - (key in before)
+        if amount or count:
+            update_total(key[0], key[1], amount, count)
+
+
+def forget(categoryid):
+    """Delete the daily totals of a category"""
+    models.CategoryDailyTotal.query.filter(
+        models.CategoryDailyTotal.category_id == categoryid
+    ).delete(synchronize_session=False)
+
+
+def history(username=None):
+    """
+    Return the first and last days of all transactions, or of the given user's
+    transactions (None, None if there is no transaction)
+    """
+    query = db.session.query(db.func.min(models.Transaction.date),
+                             db.func.max(models.Transaction.date))
+    if username:
+        query = query.filter(models.Transaction.owner_username == username)
+    return query.one()
+
+
+def rebuild(username=None, categoryid=None, first=None, last=None):
+    """
+    Rebuild daily totals from the transactions
+
+    If "username" is given, only this user's categories are rebuilt. If
+    "categoryid" is given, only this category is rebuilt (after its amounts
+    have been converted to another currency). If "first" and/or "last" are
+    given, only days in this range are rebuilt (used to rebuild big databases
+    in batches).
+
+    Return the number of daily totals. The caller is responsible for
+    committing the session.
+    """
+    def daterange(column):
+        conditions = []
+        if first:
+            conditions.append(column >= first)
+        if last:
+            conditions.append(column <= last)
+        return conditions
+
+    built = 0
+    totals = models.CategoryDailyTotal.query
+    conditions = daterange(models.CategoryDailyTotal.day)
+    if username:
+        conditions.append(models.CategoryDailyTotal.owner_username == username)
+    if categoryid:
+        conditions.append(models.CategoryDailyTotal.category_id == categoryid)
+    if conditions:
+        totals = totals.filter(db.and_(*conditions))
+    totals.delete(synchronize_session=False)
+    query = db.session.query(
+        models.TransactionCategory.category_id,
+        models.Transaction.date,
+        models.Category.owner_username,
+        db.func.sum(models.TransactionCategory.category_amount),
+        db.func.count(models.TransactionCategory.transaction_id)
+    ).join(
+        models.Transaction,
+        models.TransactionCategory.transaction_id == models.Transaction.id
+    ).join(
+        models.Category,
+        models.TransactionCategory.category_id == models.Category.id
+    )
+    conditions = daterange(models.Transaction.date)
+    if username:
+        conditions.append(models.Category.owner_username == username)
+    if categoryid:
+        conditions.append(models.Category.id == categoryid)
+    if conditions:
+        query = query.filter(db.and_(*conditions))
+    for categoryid, day, owner, amount, count in query.group_by(
+        models.TransactionCategory.category_id,
+        models.Transaction.date,
+        models.Category.owner_username
+    ):
+        db.session.add(models.CategoryDailyTotal(
+            category_id=categoryid,
+            day=day,
+            owner_username=owner,
+            amount=amount,
+            transactions_count=count
+        ))
+        built += 1
+    db.session.flush()
+    return built
+
+
+def batches(first, last, days=90):
+    """Split the range of days between "first" and "last" in batches"""
+    while first <= last:
+        yield first, min(first + datetime.timedelta(days - 1), last)
+        first = first + datetime.timedelta(days)
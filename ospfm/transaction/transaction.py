@@ -15,14 +15,14 @@
 #    You should have received a copy of the GNU Affero General Public License
 #    along with OSPFM.  If not, see <http://www.gnu.org/licenses/>.
 
-import datetime, json
+import base64, datetime
 
-from flask import jsonify
+from flask import Response, json, jsonify, stream_with_context
 
 from ospfm import db, helpers
 from ospfm.core import currency
 from ospfm.core import models as core
-from ospfm.transaction import models
+from ospfm.transaction import balance, closure, models, rollup
 from ospfm.objects import Object
 
 
@@ -31,8 +31,12 @@ class Transaction(Object):
     def __own_transaction(self, transactionid):
         return models.Transaction.query.options(
                           db.joinedload(models.Transaction.currency),
-                          db.joinedload(models.Transaction.transaction_accounts),
-                          db.joinedload(models.Transaction.transaction_categories)
+                          db.joinedload(models.Transaction.transaction_accounts
+                            ).joinedload(models.TransactionAccount.account
+                            ).joinedload(models.Account.currency),
+                          db.joinedload(models.Transaction.transaction_categories
+                            ).joinedload(models.TransactionCategory.category
+                            ).joinedload(models.Category.currency)
                ).filter(
                     db.and_(
                         models.Transaction.owner_username == self.username,
@@ -137,6 +141,11 @@ class Transaction(Object):
                     self.add_to_response('categoriesbalance',
                                          categorydata['category'])
 
+        # Update accounts running balances and categories daily totals
+        db.session.flush()
+        balance.update_accounts({}, balance.account_lines(transaction.id))
+        rollup.update({}, rollup.lines(transaction.id))
+
         # Commit everything...
         db.session.commit()
         return transaction.as_dict(self.username)
@@ -152,6 +161,8 @@ class Transaction(Object):
         if not transaction:
             self.notfound(
            'Nonexistent transaction cannot be modified (or you do not own it)')
+        account_lines = balance.account_lines(transaction.id)
+        lines = rollup.lines(transaction.id)
 
         # First, modifications on the Transaction object itself
         if 'description' in self.args:
@@ -289,6 +300,9 @@ class Transaction(Object):
                 self.add_to_response('categoriesbalance', categoryid)
                 db.session.delete(tc)
 
+        balance.update_accounts(account_lines,
+                                balance.account_lines(transaction.id))
+        rollup.update(lines, rollup.lines(transaction.id))
         db.session.commit()
         return transaction.as_dict(self.username)
 
@@ -302,94 +316,188 @@ class Transaction(Object):
             self.add_to_response('accountbalance', ta.account_id)
         for tc in transaction.transaction_categories:
             self.add_to_response('categoriesbalance', tc.category_id)
+        account_lines = balance.account_lines(transaction.id)
+        lines = rollup.lines(transaction.id)
         db.session.delete(transaction)
+        balance.update_accounts(account_lines, {})
+        rollup.update(lines, {})
         db.session.commit()
 
     def http_filter(self):
         self._Object__init_http()
-        return jsonify(status=200, response=self.__filter(self.args))
+        db.use_replica()
+        try:
+            transactions, next_cursor = self.__filter(self.args)
+        finally:
+            db.use_primary()
+        return jsonify(status=200, response=transactions,
+                       next_cursor=next_cursor)
 
-    def __filter(self, filter):
+    def http_export(self):
+        self._Object__init_http()
+        filters = self.__filters(self.args)
+        def export():
+            position = None
+            db.use_replica()
+            try:
+                while True:
+                    criteria = list(filters)
+                    if position:
+                        criteria.extend(position_filter(*position))
+                    transactions = self.__query(criteria).limit(
+                                                          EXPORT_CHUNK).all()
+                    # A short chunk does not mean the end was reached, only
+                    # an empty one does
+                    if not transactions:
+                        break
+                    for transaction in transactions:
+                        yield json.dumps(
+                                    transaction.as_dict(self.username)
+                              ) + '\n'
+                    position = (transactions[-1].date, transactions[-1].id)
+                    # Only one chunk of transactions is kept in memory
+                    del transactions
+                    db.session.expunge_all()
+            finally:
+                db.use_primary()
+        return Response(stream_with_context(export()),
+                        mimetype='application/x-ndjson')
+
+    def __filters(self, filter):
+        """Return the criteria of the filter (see filter_functions)"""
         filters = [
             models.Transaction.owner_username == self.username,
         ]
-        limit = 100
-        after = False
         for part in filter.items():
             if part[0] in filter_functions:
                 filters.extend(
                     filter_functions[part[0]](part[1])
                 )
-            elif part[0] == 'limit':
+        return filters
+
+    def __query(self, filters):
+        """
+        Return the query of the transactions matching the criteria, with their
+        links, sorted by date and id (most recent first)
+        """
+        return models.Transaction.query.options(
+                    db.joinedload(models.Transaction.currency),
+                    # Accounts and categories are also needed by as_dict()
+                    db.joinedload(models.Transaction.transaction_accounts
+                      ).joinedload(models.TransactionAccount.account
+                      ).joinedload(models.Account.currency),
+                    db.joinedload(models.Transaction.transaction_categories
+                      ).joinedload(models.TransactionCategory.category
+                      ).joinedload(models.Category.currency)
+                ).order_by(
+                    db.desc(models.Transaction.date),
+                    db.desc(models.Transaction.id)
+                ).filter(
+                    db.and_(
+                        *filters
+                    )
+                )
+
+    def __filter(self, filter):
+        """
+        Return the transactions matching the filter, sorted by date and id
+        (most recent first), and the cursor of the next page (None if this is
+        the last page)
+        """
+        filters = self.__filters(filter)
+        limit = 100
+        position = None
+        for part in filter.items():
+            if part[0] == 'limit':
                 try:
                     limit = min(int(part[1]), 100)
                 except:
                     pass
-            elif part[0] == 'after':
+            elif part[0] == 'cursor':
+                position = decode_cursor(part[1])
+                if not position:
+                    self.badrequest("This cursor cannot be understood")
+            elif part[0] == 'after' and 'cursor' not in filter:
+                # Previous pagination, by transaction id
                 try:
-                    after = int(part[1])
-                except:
-                    pass
-        if after:
-            # Get offset of the "from" transaction
-            # XXX: Is there a more efficient way to do so ?
-            all_transactions = db.session.query(models.Transaction.id).order_by(
-                                db.desc(models.Transaction.date)
-                           ).filter(
-                                db.and_(
-                                    *filters
-                                )
-                           )
-            all_ids = [t.id for t in all_transactions]
-            try:
-                offset = all_ids.index(after) + 1
-            except:
-                offset = 0
-            transactions = models.Transaction.query.options(
-                        db.joinedload(models.Transaction.currency),
-                        db.joinedload(models.Transaction.transaction_accounts),
-                        db.joinedload(models.Transaction.transaction_categories)
-                    ).order_by(
-                        db.desc(models.Transaction.date)
+                    position = db.session.query(
+                        models.Transaction.date,
+                        models.Transaction.id
                     ).filter(
                         db.and_(
-                            *filters
+                            models.Transaction.owner_username == \
+                                                                self.username,
+                            models.Transaction.id == int(part[1])
                         )
-                    ).offset(offset).limit(limit)
-            return [t.as_dict(self.username) for t in transactions]
+                    ).first()
+                except:
+                    pass
+        if position:
+            filters.extend(position_filter(*position))
+        transactions = self.__query(filters).limit(limit).all()
+        if len(transactions) == limit:
+            next_cursor = encode_cursor(transactions[-1].date,
+                                        transactions[-1].id)
         else:
-            transactions = models.Transaction.query.options(
-                        db.joinedload(models.Transaction.currency),
-                        db.joinedload(models.Transaction.transaction_accounts),
-                        db.joinedload(models.Transaction.transaction_categories)
-                    ).order_by(
-                        db.desc(models.Transaction.date)
-                    ).filter(
-                        db.and_(
-                            *filters
-                        )
-                    ).limit(limit)
-            return [t.as_dict(self.username) for t in transactions]
+            next_cursor = None
+        return [t.as_dict(self.username) for t in transactions], next_cursor
 
+# Number of transactions loaded at once by exports
+EXPORT_CHUNK = 500
+
+def position_filter(date, transactionid):
+    """
+    Keyset pagination: only transactions after the given position (with the
+    order of Transaction.__query)
+    """
+    return [
+        db.or_(
+            models.Transaction.date < date,
+            db.and_(
+                models.Transaction.date == date,
+                models.Transaction.id < transactionid
+            )
+        )
+    ]
+
+def encode_cursor(date, transactionid):
+    """Return an opaque cursor for the position of a transaction"""
+    return base64.urlsafe_b64encode(
+                '{0}:{1}'.format(date.strftime('%Y-%m-%d'), transactionid)
+           )
+
+def decode_cursor(cursor):
+    """Return the (date, transaction id) of a cursor, or None if invalid"""
+    try:
+        date, transactionid = base64.urlsafe_b64decode(
+                                                     str(cursor)).split(':')
+        date = helpers.date_from_string(date)
+        if date:
+            return date, int(transactionid)
+    except (TypeError, ValueError):
+        pass
+    return None
+
+# Links are filtered with subqueries, so each transaction is only one row
+# (LIMIT, used by pagination and exports, counts rows)
 def account_filter(value):
     return [
-        models.Transaction.id == models.TransactionAccount.transaction_id,
-        models.TransactionAccount.account_id == value
+        models.Transaction.id.in_(
+            db.session.query(models.TransactionAccount.transaction_id).filter(
+                models.TransactionAccount.account_id == value
+            ).subquery()
+        )
     ]
 def category_filter(value):
-    def subcategories(categoryid, categorylist):
-        for cat in models.Category.query.filter(
-                        models.Category.parent_id == categoryid
-                    ):
-            categorylist.append(cat.id)
-            categorylist = subcategories(cat.id, categorylist)
-        return categorylist
-
-    categorylist = subcategories(value, [ int(value) ])
+    # The closure includes the category itself (depth 0)
     return [
-        models.Transaction.id == models.TransactionCategory.transaction_id,
-        db.or_(*[ models.TransactionCategory.category_id == value \
-               for value in categorylist ])
+        models.Transaction.id.in_(
+            db.session.query(models.TransactionCategory.transaction_id).filter(
+                models.TransactionCategory.category_id.in_(
+                    closure.descendants_ids(value).subquery()
+                )
+            ).subquery()
+        )
     ]
 def currency_filter(value):
     return [
@@ -0,0 +1,331 @@
+#    Copyright 2012-2013 Sebastien Maccagnoni-Munch
+#
+#    This file is part of OSPFM.
+#
+#    OSPFM is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    OSPFM is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with OSPFM.  If not, see <http://www.gnu.org/licenses/>.
+import csv
+import json
+from decimal import Decimal, InvalidOperation
+
+from ospfm import db, helpers
+from ospfm.core import models as core
+from ospfm.transaction import balance, models, rollup
+from ospfm.objects import Object
+
+# Number of transactions inserted at once
+IMPORT_CHUNK = 500
+
+# Columns of CSV imports
+CSV_COLUMNS = ('date', 'description', 'original_description', 'amount',
+               'currency', 'accounts', 'categories')
+
+
+class TransactionImport(Object):
+
+    def create(self):
+        if 'transactions' in self.args:
+            try:
+                rows = json.loads(self.args['transactions'])
+            except ValueError:
+                self.badrequest("The transactions cannot be understood")
+            if type(rows) != type([]):
+                self.badrequest("The transactions must be a list")
+        elif 'csv' in self.args:
+            rows = csv_rows(self.args['csv'])
+        else:
+            self.badrequest("Please provide transactions or csv")
+
+        errors = []
+        transactions = []
+        # First, parse all rows
+        for number, row in enumerate(rows):
+            try:
+                transactions.append((number, parse_row(row)))
+            except ValueError, error:
+                errors.append({'row': number, 'details': error.args[0]})
+
+        # Next, validate currencies, accounts and categories only once each
+        currencies = dict(
+            (isocode, currencyid) for isocode, currencyid, owner in \
+            db.session.query(
+                core.Currency.isocode,
+                core.Currency.id,
+                core.Currency.owner_username
+            ).filter(
+                db.or_(
+                    core.Currency.owner_username == self.username,
+                    core.Currency.owner_username == None
+                )
+            # User's currencies override global currencies
+            ).order_by(core.Currency.owner_username != None)
+        )
+        accountids = set()
+        categoryids = set()
+        for number, transaction in transactions:
+            accountids.update([ a[0] for a in transaction['accounts'] ])
+            categoryids.update([ c[0] for c in transaction['categories'] ])
+        if accountids:
+            accountids = set([ ao.account_id for ao in \
+                models.AccountOwner.query.filter(
+                    db.and_(
+                        models.AccountOwner.owner_username == self.username,
+                        models.AccountOwner.account_id.in_(accountids)
+                    )
+                ) ])
+        if categoryids:
+            # Categories currencies, to convert missing category amounts
+            categoryids = dict( c for c in db.session.query(
+                    models.Category.id,
+                    core.Currency.isocode
+                ).join(models.Category.currency).filter(
+                    db.and_(
+                        models.Category.owner_username == self.username,
+                        models.Category.id.in_(categoryids)
+                    )
+                ) )
+        valid = []
+        for number, transaction in transactions:
+            if transaction['currency'] not in currencies:
+                errors.append({'row': number,
+                               'details': "This currency does not exist"})
+            elif [ a for a in transaction['accounts']
+                   if a[0] not in accountids ]:
+                errors.append({'row': number,
+                               'details': "This account does not exist"})
+            elif [ c for c in transaction['categories']
+                   if c[0] not in categoryids ]:
+                errors.append({'row': number,
+                               'details': "This category does not exist"})
+            else:
+                transaction['currency_id'] = currencies[
+                                                    transaction['currency']]
+                transaction['categories'] = [
+                    (categoryid, transaction_amount,
+                     transaction_amount * helpers.rate(
+                        self.username, transaction['currency'],
+                        categoryids[categoryid], on_date=transaction['date']
+                     ) if category_amount is None else category_amount)
+                    for categoryid, transaction_amount, category_amount \
+                                                    in transaction['categories']
+                ]
+                valid.append(transaction)
+
+        # Then, insert the transactions and their links by chunks
+        for first in range(0, len(valid), IMPORT_CHUNK):
+            insert(self.username, valid[first:first+IMPORT_CHUNK])
+
+        # Finally, update running balances and daily totals once for all
+        accounts = {}
+        lines = {}
+        for transaction in valid:
+            for accountid, amount in transaction['accounts']:
+                total = accounts.setdefault(accountid, [0, 0])
+                total[0] += amount
+                total[1] += 1
+            for categoryid, transaction_amount, amount in \
+                                                    transaction['categories']:
+                total = lines.setdefault((categoryid, transaction['date']),
+                                         [0, 0])
+                total[0] += amount
+                total[1] += 1
+        for accountid, (amount, count) in accounts.items():
+            balance.update_account(accountid, amount, count)
+        categories = set()
+        for (categoryid, day), (amount, count) in lines.items():
+            rollup.update_total(categoryid, day, amount, count)
+            categories.add(categoryid)
+        db.session.commit()
+
+        for accountid in accounts:
+            self.add_to_response('accountbalance', accountid)
+        if accounts:
+            self.add_to_response('totalbalance')
+        for categoryid in categories:
+            self.add_to_response('categoriesbalance', categoryid)
+        errors.sort(key=lambda e: e['row'])
+        return {
+            'imported': len(valid),
+            'errors': errors
+        }
+
+
+def decimal(value):
+    """Convert an amount to a Decimal, or raise ValueError"""
+    try:
+        return Decimal(str(value).strip())
+    except (InvalidOperation, UnicodeEncodeError):
+        raise ValueError("This amount cannot be understood")
+
+def parse_row(row):
+    """
+    Check and normalize a transaction to import:
+        {
+            'description': <description>,
+            'original_description': <original description>,
+            'amount': <amount>,
+            'currency': <isocode>,
+            'date': <date>,
+            'accounts': [ (<account id>, <amount>), ... ],
+            'categories': [
+                (<category id>, <transaction amount>, <category amount>),
+                ...
+            ]
+        }
+
+    A missing category amount is None: it is converted from the transaction
+    amount once the category currency is known
+
+    Raise ValueError with the error details if the transaction is invalid
+    """
+    if type(row) != type({}):
+        raise ValueError("A transaction must be an object")
+    for mandatory in ('description', 'amount', 'currency', 'date'):
+        if row.get(mandatory) in (None, ''):
+            raise ValueError("Please provide transaction description, "
+                             "currency, amount and date")
+    date = helpers.date_from_string(unicode(row['date']))
+    if not date:
+        raise ValueError("This date cannot be understood")
+    transaction = {
+        'description': row['description'],
+        'original_description': row.get('original_description') or \
+                                                            row['description'],
+        'amount': decimal(row['amount']),
+        'currency': row['currency'],
+        'date': date,
+        'accounts': [],
+        'categories': []
+    }
+    try:
+        for account in row.get('accounts') or []:
+            transaction['accounts'].append(
+                (int(account['account']), decimal(account['amount']))
+            )
+        for category in row.get('categories') or []:
+            transaction_amount = decimal(category['transaction_amount'])
+            if category.get('category_amount') is None:
+                category_amount = None
+            else:
+                category_amount = decimal(category['category_amount'])
+            transaction['categories'].append(
+                (int(category['category']), transaction_amount,
+                 category_amount)
+            )
+    except (KeyError, TypeError):
+        raise ValueError("The accounts or categories cannot be understood")
+    if len(set([ a[0] for a in transaction['accounts'] ])) < \
+                                                len(transaction['accounts']) or \
+       len(set([ c[0] for c in transaction['categories'] ])) < \
+                                                len(transaction['categories']):
+        raise ValueError("An account or a category is given twice")
+    return transaction
+
+def csv_rows(data):
+    """
+    Read transactions from CSV data, in the same format as JSON transactions
+
+    Columns are those of CSV_COLUMNS (a header line with these names may be
+    given to use another order). Accounts are given as
+    "<account id>:<amount> ...", categories as
+    "<category id>:<transaction amount>[:<category amount>] ...".
+    """
+    lines = csv.reader(data.encode('utf8').splitlines())
+    rows = []
+    columns = CSV_COLUMNS
+    for number, line in enumerate(lines):
+        if not line:
+            continue
+        line = [ cell.decode('utf8').strip() for cell in line ]
+        if number == 0 and 'date' in line and 'amount' in line:
+            columns = line
+            continue
+        row = dict(zip(columns, line))
+        row['accounts'] = [
+            dict(zip(('account', 'amount'), split.split(':')))
+            for split in row.get('accounts', '').split()
+        ]
+        row['categories'] = [
+            dict(zip(
+                ('category', 'transaction_amount', 'category_amount'),
+                split.split(':')
+            ))
+            for split in row.get('categories', '').split()
+        ]
+        rows.append(row)
+    return rows
+
+def insert(username, transactions):
+    """Insert transactions and their links"""
+    if hasattr(db.session, 'bulk_insert_mappings'):
+        # Only the ids of the transactions are needed back
+        mappings = [ {
+            'owner_username': username,
+            'description': t['description'],
+            'original_description': t['original_description'],
+            'amount': t['amount'],
+            'currency_id': t['currency_id'],
+            'date': t['date']
+        } for t in transactions ]
+        db.session.bulk_insert_mappings(models.Transaction, mappings,
+                                        return_defaults=True)
+        for transaction, mapping in zip(transactions, mappings):
+            transaction['id'] = mapping['id']
+        db.session.bulk_insert_mappings(models.TransactionAccount, [ {
+            'transaction_id': t['id'],
+            'account_id': accountid,
+            'amount': amount,
+            'verified': False
+        } for t in transactions for accountid, amount in t['accounts'] ])
+        db.session.bulk_insert_mappings(models.TransactionCategory, [ {
+            'transaction_id': t['id'],
+            'category_id': categoryid,
+            'transaction_amount': transaction_amount,
+            'category_amount': category_amount
+        } for t in transactions
+          for categoryid, transaction_amount, category_amount \
+                                                        in t['categories'] ])
+    else:
+        # Older SQLAlchemy: one flush for the whole chunk
+        objects = []
+        for t in transactions:
+            transaction = models.Transaction(
+                owner_username=username,
+                description=t['description'],
+                original_description=t['original_description'],
+                amount=t['amount'],
+                currency_id=t['currency_id'],
+                date=t['date']
+            )
+            objects.append(transaction)
+            for accountid, amount in t['accounts']:
+                objects.append(models.TransactionAccount(
+                    transaction=transaction,
+                    account_id=accountid,
+                    amount=amount,
+                    verified=False
+                ))
+            for categoryid, transaction_amount, category_amount in \
+                                                               t['categories']:
+                objects.append(models.TransactionCategory(
+                    transaction=transaction,
+                    category_id=categoryid,
+                    transaction_amount=transaction_amount,
+                    category_amount=category_amount
+                ))
+        db.session.add_all(objects)
+        db.session.flush()
+        # Keep memory flat on big imports (links are expunged by cascade)
+        for o in objects:
+            if isinstance(o, models.Transaction):
+                db.session.expunge(o)
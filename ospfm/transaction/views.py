@@ -19,6 +19,7 @@ from ospfm import app
 from ospfm.transaction.account import Account
 from ospfm.transaction.category import Category
 from ospfm.transaction.transaction import Transaction
+from ospfm.transaction.transactionimport import TransactionImport
 
 # ACCOUNTS
 
@@ -42,3 +43,11 @@ def transactions(transactionid=None):
 @app.route('/transactions/filter')
 def transaction_filter():
     return Transaction().http_filter()
+
+@app.route('/transactions/export')
+def transaction_export():
+    return Transaction().http_export()
+
+@app.route('/transactions/import', methods=['POST'])
+def transaction_import():
+    return TransactionImport().http_request()
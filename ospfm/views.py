@@ -23,6 +23,8 @@ if config.DEVEL:
         response.headers.add('Access-Control-Allow-Origin', '*')
         response.headers.add('Access-Control-Allow-Methods', 'GET,POST,DELETE')
         response.headers.add('Access-Control-Allow-Headers', 'X-Requested-With')
+        response.headers.add('Access-Control-Expose-Headers',
+                             'X-OSPFM-Key, X-OSPFM-Queries')
         return response
 
 @app.route('/')
@@ -33,6 +35,12 @@ def root():
 def login():
     return authentication.authenticate()
 
+@app.route('/logout', methods=['POST'])
+def logout():
+    return authentication.logout()
+
 from ospfm.core import views
 from ospfm.transaction import views
+import batch
+import metrics
 import wizard
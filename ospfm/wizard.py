@@ -18,6 +18,7 @@
 import codecs
 import datetime
 import os
+from decimal import Decimal
 
 import ConfigParser
 
@@ -27,7 +28,9 @@ from sqlalchemy.exc import StatementError
 
 from ospfm import app, authentication, config, db, helpers
 
+from ospfm.core import dataversion
 from ospfm.core import models as core
+from ospfm.transaction import balance, closure, rollup
 from ospfm.transaction import models as transaction
 
 
@@ -39,191 +42,238 @@ def wizards(wizard, locale, currency):
                                      request.values.to_dict().get('key', None))
         if username in config.DEMO_ACCOUNTS:
             abort(400)
-        delete_everything(username)
+        formerowners = delete_everything(username)
         status, response = create(username, wizard, locale, currency)
+        db.session.commit()
+        dataversion.bump(username, formerowners)
         return jsonify(status=status, response=response)
     except StatementError:
         db.session.rollback()
 
 
 def delete_everything(username):
-    """Delete all data except user preferences"""
-    # Transaction
-    #  -> TransactionAccount and TransactionCategory deleted by cascade
+    """
+    Delete all data except user preferences, in a fixed number of statements
+
+    Link tables are purged explicitly (SQLite does not enforce cascades).
+    Accounts shared with other users are kept, with their balances rebuilt.
+    Return the usernames of these other users.
+
+    The caller is responsible for committing the session.
+    """
+    # Transaction, with its links
+    transactionids = db.session.query(transaction.Transaction.id).filter(
+                        transaction.Transaction.owner_username == username
+                     ).subquery()
+    for link in (transaction.TransactionAccount,
+                 transaction.TransactionCategory):
+        link.query.filter(
+            link.transaction_id.in_(transactionids)
+        ).delete(synchronize_session=False)
     transaction.Transaction.query.filter(
         transaction.Transaction.owner_username == username
-    ).delete()
-    # Category
+    ).delete(synchronize_session=False)
+    # Category, with its daily totals and its place in the categories tree
+    transaction.CategoryDailyTotal.query.filter(
+        transaction.CategoryDailyTotal.owner_username == username
+    ).delete(synchronize_session=False)
+    transaction.CategoryClosure.query.filter(
+        transaction.CategoryClosure.descendant_id.in_(
+            db.session.query(transaction.Category.id).filter(
+                transaction.Category.owner_username == username
+            ).subquery()
+        )
+    ).delete(synchronize_session=False)
     transaction.Category.query.filter(
         transaction.Category.owner_username == username
-    ).delete()
+    ).delete(synchronize_session=False)
     # Account
-    # ... first get all accounts for the user...
-    accountowners = transaction.AccountOwner.query.filter(
-                        transaction.AccountOwner.owner_username == username
-                    ).all()
+    # ... first get the accounts of the user, and whether they are shared
+    # with other users...
+    otherowner = db.aliased(transaction.AccountOwner)
+    accounts = db.session.query(
+        transaction.AccountOwner.account_id,
+        db.session.query(otherowner).filter(
+            otherowner.account_id == transaction.AccountOwner.account_id,
+            otherowner.owner_username != username
+        ).exists()
+    ).filter(
+        transaction.AccountOwner.owner_username == username
+    ).all()
+    sharedaccountids = [ a[0] for a in accounts if a[1] ]
+    ownaccountids = [ a[0] for a in accounts if not a[1] ]
+    formerowners = set([ ao[0] for ao in db.session.query(
+        transaction.AccountOwner.owner_username
+    ).filter(
+        transaction.AccountOwner.account_id.in_(sharedaccountids),
+        transaction.AccountOwner.owner_username != username
+    ) ]) if sharedaccountids else set()
     # ... then delete all "AccountOwner" links for the user...
     transaction.AccountOwner.query.filter(
         transaction.AccountOwner.owner_username == username
-    ).delete()
-    # ... and delete only accounts which do not have user associated...
-    deleteaccounts = []
-    for accountowner in accountowners:
-        if not transaction.AccountOwner.query.filter(
-                transaction.AccountOwner.account_id == accountowner.account_id
-        ).first():
-            deleteaccounts.append(
-                transaction.Account.id == accountowner.account_id
-            )
-    if deleteaccounts:
+    ).delete(synchronize_session=False)
+    # ... and delete the accounts nobody else owns, with their links and
+    # balances
+    if ownaccountids:
+        for link in (transaction.TransactionAccount,
+                     transaction.AccountBalance):
+            link.query.filter(
+                link.account_id.in_(ownaccountids)
+            ).delete(synchronize_session=False)
         transaction.Account.query.filter(
-            db.or_(*deleteaccounts)
-        ).delete()
+            transaction.Account.id.in_(ownaccountids)
+        ).delete(synchronize_session=False)
+    # ... and rebuild balances of the accounts still shared with other users
+    balance.rebuild_accounts(accountids=sharedaccountids)
     # Currency
     core.Currency.query.filter(
         core.Currency.owner_username == username
-    ).delete()
-    # XXX TransactionAccounts are not deleted : problem with SQLite
-    # Commit deletes
-    db.session.commit()
+    ).delete(synchronize_session=False)
+    return formerowners
+
+
+# Wizard data files are parsed once, when the application starts (files added
+# later are only used after a restart): each one is kept as the ordered list
+# of its sections, with their options.
+#
+# Entries are then created in a single database transaction, with the rates
+# of each currency pair resolved only once and the links of transactions to
+# accounts and categories inserted in bulk.
 
+__wizard_data = {}
+
+def __parse(name):
+    """Parse a wizard data file, return its sections or None"""
+    data = ConfigParser.RawConfigParser()
+    try:
+        datafile = codecs.open(os.path.join(config.WIZARD_DATA, name),
+                               'r', 'utf8')
+        data.readfp(datafile)
+        datafile.close()
+    except (IOError, ConfigParser.Error):
+        return None
+    return [ (section, dict(data.items(section)))
+             for section in data.sections() ]
+
+def load_wizard_data():
+    """Parse all wizard data files"""
+    if os.path.isdir(config.WIZARD_DATA):
+        for name in os.listdir(config.WIZARD_DATA):
+            if name.endswith(('.basic', '.demo')):
+                sections = __parse(name)
+                if sections is not None:
+                    __wizard_data[name] = sections
+
+def wizard_sections(wizard, locale):
+    """Return the sections of a wizard, for a locale (abort if unavailable)"""
+    if wizard == 'basic':
+        names = ('{0}.basic'.format(locale),)
+    elif wizard == 'demo':
+        names = ('{0}.basic'.format(locale), '{0}.demo'.format(locale))
+    else:
+        return []
+    sections = []
+    for name in names:
+        # Only files parsed at startup are known: nothing is added here, whatever
+        # the locale requested
+        if name not in __wizard_data:
+            abort(400)
+        sections.extend(__wizard_data[name])
+    return sections
+
+load_wizard_data()
 
 
 def create(username, wizard, locale, prefcurrency):
-    """Create entries from wizard files"""
+    """
+    Create entries from wizard files
 
-    # /!\ Does not work in Python < 2.7
-    #
-    # (sections order is important)
+    The caller is responsible for committing the session.
+    """
 
     ########## Initialization
-    data = ConfigParser.RawConfigParser()
-    if wizard in ('basic', 'demo'):
-        try:
-            datafile = codecs.open(
-                            os.path.join(config.WIZARD_DATA,'%s.basic'%locale),
-                            'r', 'utf8'
-                        )
-            data.readfp(datafile)
-            datafile.close()
-        except:
-            abort(400)
-    if wizard == 'demo':
-        try:
-            datafile = codecs.open(
-                            os.path.join(config.WIZARD_DATA, '%s.demo'%locale),
-                            'r', 'utf8'
-                        )
-            data.readfp(datafile)
-            datafile.close()
-        except:
-            abort(400)
-    sections = data.sections()
+    sections = wizard_sections(wizard, locale)
     if not sections:
         return 200, 'OK'
-    try:
-        preferred_currency = core.Currency.query.filter(
-                                    db.and_(
-                                        core.Currency.isocode == prefcurrency,
-                                        core.Currency.owner_username == None
-                                    )
-                                ).one()
-    except:
-        abort(400)
 
     today = datetime.date.today()
 
     ########## Helper functions
     def subsections(name):
-        return [ i for i in sections if i.startswith(name) ]
+        return [ i for i in sections if i[0].startswith(name) ]
+
+    ########## Global currencies, all at once
+    isocodes = set([prefcurrency] + [ options['currency']
+                                      for section, options in sections
+                                      if 'currency' in options ])
+    currencies = dict([ (currency.isocode, currency) for currency in
+                        core.Currency.query.filter(
+                            db.and_(
+                                core.Currency.isocode.in_(isocodes),
+                                core.Currency.owner_username == None
+                            )
+                        ) ])
+    if prefcurrency not in currencies:
+        abort(400)
+    def currency(options):
+        curname = options.get('currency', prefcurrency)
+        if curname not in currencies:
+            abort(400)
+        return currencies[curname]
 
     ########## Currency
-    currencies = { prefcurrency: preferred_currency }
-    for cur in subsections('currency-'):
-        symbol = data.get(cur, 'symbol')
-        currency = core.Currency(
-                        owner_username = username,
-                        isocode = symbol,
-                        symbol = symbol,
-                        name = data.get(cur, 'name'),
-                        rate = data.get(cur, 'rate')
-                    )
-        db.session.add(currency)
-        currencies[symbol] = currency
-    db.session.commit()
+    for cur, options in subsections('currency-'):
+        symbol = options['symbol']
+        currencies[symbol] = core.Currency(
+                                owner_username = username,
+                                isocode = symbol,
+                                symbol = symbol,
+                                name = options['name'],
+                                rate = options['rate']
+                             )
+    db.session.add_all([ c for c in currencies.values()
+                         if c.owner_username == username ])
 
     ########## Account
     accounts = {}
-    for acc in subsections('account-'):
-        if data.has_option(acc, 'currency'):
-            curname = data.get(acc, 'currency')
-            if curname not in currencies:
-                currencies[curname] = core.Currency.query.filter(
-                    db.and_(
-                        core.Currency.owner_username == None,
-                        core.Currency.isocode == curname
-                    )
-                ).one()
-        else:
-            curname = prefcurrency
+    for acc, options in subsections('account-'):
         account = transaction.Account(
-            name = data.get(acc, 'name'),
-            currency = currencies[curname],
-            start_balance = data.get(acc, 'balance')
+            name = options['name'],
+            currency = currency(options),
+            start_balance = options['balance']
         )
-        db.session.add(account)
         accounts[acc.split('-')[1]] = account
+        db.session.add(account)
         db.session.add(
             transaction.AccountOwner(
                 account = account,
                 owner_username = username
             )
         )
-    db.session.commit()
 
     ########## Category
     categories = {}
-    for cat in subsections('category-'):
-        if data.has_option(cat, 'currency'):
-            curname = data.get(cat, 'currency')
-            if curname not in currencies:
-                currencies[curname] = core.Currency.query.filter(
-                    db.and_(
-                        core.Currency.owner_username == None,
-                        core.Currency.isocode == curname
-                    )
-                ).one()
-        else:
-            curname = prefcurrency
+    for cat, options in subsections('category-'):
         category = transaction.Category(
             owner_username = username,
-            currency = currencies[curname],
-            name = data.get(cat, 'name')
+            currency = currency(options),
+            name = options['name']
         )
-        try:
-            category.parent = categories[data.get(cat, 'parent')]
-        except:
-            pass
+        if options.get('parent') in categories:
+            category.parent = categories[options['parent']]
         db.session.add(category)
         categories[cat.split('-')[1]] = category
-    db.session.commit()
+    db.session.flush()
+    closure.rebuild(username)
+    # User currencies have just been created
+    helpers.reset_rates()
 
     ########## Transaction
-    for tra in subsections('transaction-'):
-        if data.has_option(tra, 'currency'):
-            curname = data.get(tra, 'currency')
-            if curname not in currencies:
-                currencies[curname] = core.Currency.query.filter(
-                    db.and_(
-                        core.Currency.owner_username == None,
-                        core.Currency.isocode == curname
-                    )
-                ).one()
-        else:
-            curname = prefcurrency
-        currency = currencies[curname]
+    transactions = []
+    for tra, options in subsections('transaction-'):
+        trcurrency = currency(options)
         # Calculate date
-        year, month, day = data.get(tra, 'date').split('/')
+        year, month, day = options['date'].split('/')
         # Month
         if month:
             if month[0] in ('-', '+'):
@@ -277,60 +327,56 @@ def create(username, wizard, locale, prefcurrency):
         # Create transaction
         trans = transaction.Transaction(
             owner_username = username,
-            description = data.get(tra, 'description'),
-            amount = data.get(tra, 'amount'),
-            currency = currency,
+            description = options['description'],
+            original_description = options.get('original_description',
+                                               options['description']),
+            amount = Decimal(options['amount']),
+            currency = trcurrency,
             date = transactiondate
         )
-        try:
-            trans.original_description = data.get(tra, 'original_description')
-        except:
-            trans.original_description = data.get(tra, 'description')
-        db.session.add(trans)
-        # Links to accounts
-        for accountdata in data.get(tra, 'accounts').split():
-            accountdatatb = accountdata.split(':')
-            accountnum = accountdatatb[0]
-            if len(accountdatatb) > 1:
-                amount = accountdatatb[1]
+        transactions.append((trans, options))
+    db.session.add_all([ trans for trans, options in transactions ])
+    db.session.flush()
+
+    # Links to accounts and categories, converted with the rate of each
+    # currency pair at each date (resolved once)
+    def splits(trans, value):
+        for splitdata in value.split():
+            splitdatatb = splitdata.split(':')
+            if len(splitdatatb) > 1:
+                yield splitdatatb[0], Decimal(splitdatatb[1])
             else:
-                amount = trans.amount
+                yield splitdatatb[0], trans.amount
+    def rate(trans, tocurrency):
+        return helpers.rate(username, trans.currency.isocode,
+                            tocurrency.isocode, on_date=trans.date)
+    transactionaccounts = []
+    transactioncategories = []
+    for trans, options in transactions:
+        for accountnum, amount in splits(trans, options['accounts']):
             account = accounts[accountnum]
-            accountamount = amount * helpers.rate(
-                                            username,
-                                            currency.isocode,
-                                            account.currency.isocode
-                                        )
-            db.session.add(
-                transaction.TransactionAccount(
-                    transaction = trans,
-                    account = account,
-                    amount = accountamount
-                )
-            )
-        # Links to categories
-        for categorydata in data.get(tra, 'categories').split():
-            categorydatatb = categorydata.split(':')
-            categorynum = categorydatatb[0]
-            if len(categorydatatb) > 1:
-                amount = categorydatatb[1]
-            else:
-                amount = trans.amount
+            transactionaccounts.append({
+                'transaction_id': trans.id,
+                'account_id': account.id,
+                'amount': amount * rate(trans, account.currency),
+                'verified': False
+            })
+        for categorynum, amount in splits(trans, options['categories']):
             category = categories[categorynum]
-            categoryamount = amount * helpers.rate(
-                                            username,
-                                            currency.isocode,
-                                            category.currency.isocode
-                                        )
-            db.session.add(
-                transaction.TransactionCategory(
-                    transaction = trans,
-                    category = category,
-                    transaction_amount = amount,
-                    category_amount = categoryamount
-                )
-            )
-    db.session.commit()
+            transactioncategories.append({
+                'transaction_id': trans.id,
+                'category_id': category.id,
+                'transaction_amount': amount,
+                'category_amount': amount * rate(trans, category.currency)
+            })
+    if transactionaccounts:
+        db.session.execute(transaction.TransactionAccount.__table__.insert(),
+                           transactionaccounts)
+    if transactioncategories:
+        db.session.execute(transaction.TransactionCategory.__table__.insert(),
+                           transactioncategories)
+    balance.rebuild_accounts(username)
+    rollup.rebuild(username)
 
     ########## OK, finished
     return 200, 'OK'
@@ -0,0 +1,210 @@
+#    Copyright 2012-2013 Sebastien Maccagnoni-Munch
+#
+#    This file is part of OSPFM.
+#
+#    OSPFM is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    OSPFM is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with OSPFM.  If not, see <http://www.gnu.org/licenses/>.
+
+# SQL statements budget of the endpoints
+#
+#   python querybudget.py [--sqlite FILE]
+#
+# Each endpoint is requested on two generated datasets (see benchmark.py), a
+# small one and a ten times bigger one, and the number of SQL statements of
+# each request is counted (requests are sent twice, the first one fills the
+# caches, except FINAL_ENDPOINTS which are sent once, after all others). The
+# command fails (exit code 1) if an endpoint issues more statements on the big
+# dataset than on the small one (which means the number of statements grows
+# with the number of objects: usually a lazy relationship loaded in a loop),
+# or more than its budget.
+#
+# As benchmark.py, this command DROPS all tables of the SQLite database.
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+
+from sqlalchemy import event
+
+from ospfm import app, db
+from ospfm.transaction import models as transaction
+
+import benchmark
+
+DATASETS = (
+    ('small', {'users': 2, 'accounts': 5, 'categories': 6, 'depth': 3,
+               'transactions': 20, 'splits': 3}),
+    ('big', {'users': 2, 'accounts': 50, 'categories': 60, 'depth': 3,
+             'transactions': 200, 'splits': 3}),
+)
+
+# (method, url, data, maximum number of statements)
+# Urls and data may contain {account}, {category} and {transaction}: ids of
+# objects of the first generated user, and {key}: its authentication key
+ENDPOINTS = (
+    ('GET', '/accounts', {}, 6),
+    ('GET', '/accounts/{account}', {}, 5),
+    ('GET', '/categories', {}, 4),
+    ('GET', '/categories/{category}', {}, 5),
+    ('GET', '/transactions/{transaction}', {}, 3),
+    ('GET', '/transactions/filter', {}, 3),
+    ('GET', '/transactions/filter?category={category}', {}, 3),
+    ('GET', '/transactions/filter?account={account}', {}, 3),
+    ('GET', '/currencies', {}, 3),
+    ('GET', '/currencies/EUR/rate/USD', {}, 2),
+    ('GET', '/users/bench0', {}, 3),
+    ('GET', '/contacts', {}, 3),
+    ('GET', '/preferences', {}, 3),
+    ('POST', '/transactions', {
+        'description': 'Budget', 'amount': '-10', 'currency': 'EUR',
+        'date': '2013-01-01',
+        'accounts': '[{{"account": {account}, "amount": -10}}]',
+        'categories': '[{{"category": {category}, "transaction_amount": -10, '
+                      '"category_amount": -10}}]'
+    }, 30),
+    ('POST', '/transactions/{transaction}', {
+        'description': 'Budget update', 'amount': '-12',
+        'accounts': '[{{"account": {account}, "amount": -12}}]',
+        'categories': '[{{"category": {category}, "transaction_amount": -12, '
+                      '"category_amount": -12}}]'
+    }, 20),
+    ('POST', '/accounts/{account}', {'name': 'Budget account'}, 10),
+    ('POST', '/categories/{category}', {'name': 'Budget category'}, 10),
+    ('GET', '/transactions/export', {}, 3),
+    ('POST', '/transactions/import', {
+        'transactions': '[' + ', '.join([
+            '{{"description": "Import", "amount": "-5", "currency": "EUR", '
+            '"date": "2013-01-15", '
+            '"accounts": [{{"account": {account}, "amount": "-5"}}], '
+            '"categories": [{{"category": {category}, '
+            '"transaction_amount": "-5"}}]}}'
+        ] * 20) + ']'
+    }, 40),
+    ('POST', '/batch', {
+        'requests': '[{{"url": "/accounts"}}, {{"url": "/categories"}}, '
+                    '{{"url": "/transactions/filter?account={account}"}}]'
+    }, 12),
+)
+
+# Endpoints which delete or replace the data used by the other endpoints
+FINAL_ENDPOINTS = (
+    ('DELETE', '/transactions/{transaction}', {}, 25),
+    ('DELETE', '/accounts/{account}', {}, 15),
+    ('GET', '/wizard/basic/en-GB/EUR?key={key}', {}, 160),
+)
+
+def objects(username):
+    """Return the ids used in the urls"""
+    return {
+        'account': db.session.query(transaction.AccountOwner.account_id
+                    ).filter(
+                        transaction.AccountOwner.owner_username == username
+                    ).order_by(transaction.AccountOwner.account_id).first()[0],
+        'category': db.session.query(transaction.Category.id).filter(
+                        transaction.Category.owner_username == username,
+                        transaction.Category.parent_id == None
+                    ).order_by(transaction.Category.id).first()[0],
+        'transaction': db.session.query(transaction.Transaction.id).filter(
+                        transaction.Transaction.owner_username == username
+                    ).order_by(transaction.Transaction.id).first()[0],
+    }
+
+def count(client, key, method, url, data):
+    """Return the status code and the number of statements of a request"""
+    statements = []
+    def counter(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+    event.listen(db.engine, 'before_cursor_execute', counter)
+    try:
+        response = client.open(url, method=method, data=data,
+                               headers={'Authorization': key},
+                               environ_base={'REMOTE_ADDR': '127.0.0.1'})
+        # Streamed responses are only computed when they are read
+        response.data
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', counter)
+    return response.status_code, len(statements)
+
+def measure(url, parameters):
+    """Generate a dataset and count the statements of all endpoints"""
+    db.session.remove()
+    db.replicas = []
+    app.config['SQLALCHEMY_DATABASE_URI'] = url
+    benchmark.random.seed(0)
+    with app.app_context():
+        db.drop_all()
+        benchmark.init_db()
+        benchmark.populate_currencies()
+        benchmark.setrates()
+        usernames, rows = benchmark.generate(**parameters)
+        ids = objects(usernames[0])
+        db.session.remove()
+    client = app.test_client()
+    key = benchmark.login(client, usernames[0])
+    ids['key'] = key
+    counts = {}
+    for method, endpoint, data, budget in ENDPOINTS + FINAL_ENDPOINTS:
+        final = (method, endpoint, data, budget) in FINAL_ENDPOINTS
+        data = dict([ (name, value.format(**ids))
+                      for name, value in data.items() ])
+        if not final:
+            # The first request fills the caches (exchange rates, etc)
+            count(client, key, method, endpoint.format(**ids), data)
+        counts[(method, endpoint)] = count(client, key, method,
+                                           endpoint.format(**ids), data)
+    return counts
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Check the number of SQL statements of OSPFM endpoints. '
+                    'ALL TABLES OF THE DATABASE ARE DROPPED.'
+    )
+    parser.add_argument('--sqlite', default=os.path.join(
+                                                tempfile.gettempdir(),
+                                                'ospfm-querybudget.sqlite3'),
+                        help='SQLite database file')
+    options = parser.parse_args()
+    url = 'sqlite:///' + os.path.abspath(options.sqlite)
+
+    results = [ (name, measure(url, parameters))
+                for name, parameters in DATASETS ]
+    failures = 0
+    for method, endpoint, data, budget in ENDPOINTS + FINAL_ENDPOINTS:
+        counts = [ counts[(method, endpoint)] for name, counts in results ]
+        problems = []
+        if any([ status != 200 for status, statements in counts ]):
+            problems.append('HTTP status {0}'.format(
+                                    ', '.join([ str(status)
+                                                for status, statements
+                                                in counts ])))
+        if counts[-1][1] > counts[0][1]:
+            problems.append('grows with the dataset')
+        if max([ statements for status, statements in counts ]) > budget:
+            problems.append('over budget')
+        print '{0:4} {1:45} {2:>9} / {3:3} {4}'.format(
+            method, endpoint,
+            ' -> '.join([ str(statements) for status, statements in counts ]),
+            budget, ', '.join(problems) or 'OK'
+        )
+        if problems:
+            failures += 1
+    if failures:
+        print '{0} endpoint(s) over budget'.format(failures)
+        return 1
+    print 'All endpoints within budget'
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())